@@ -2,6 +2,7 @@ import collections
 import ctypes
 import enum
 import math
+import os
 import platform
 import socket
 
@@ -115,6 +116,42 @@ class ProgramType(enum.Enum):
     SPECIAL_READING_SERVICES = 76
 
 
+class Unknown(collections.namedtuple("Unknown", ["enum", "value"])):
+    # Stands in for enum values the broadcaster sent but this module does not list.
+    __slots__ = ()
+    name = "UNKNOWN"
+
+
+class _EnumTable(dict):
+    # Integer to member lookup built once at import. Dict indexing skips the Enum constructor, and values
+    # without a member decode to Unknown instead of raising inside the callback.
+    def __init__(self, enum_type):
+        super().__init__((member.value, member) for member in enum_type)
+        self.enum_type = enum_type
+
+    def __missing__(self, value):
+        return Unknown(self.enum_type, value)
+
+
+_EVENT_TYPES = {member.value: member for member in EventType}
+_SERVICE_TYPES = _EnumTable(ServiceType)
+_COMPONENT_TYPES = _EnumTable(ComponentType)
+_MIME_TYPES = _EnumTable(MIMEType)
+_ACCESS = _EnumTable(Access)
+_SERVICE_DATA_TYPES = _EnumTable(ServiceDataType)
+_PROGRAM_TYPES = _EnumTable(ProgramType)
+
+
+class _ArrayTypes(dict):
+    # c_char array type per audio block size, for views of libnrsc5's audio buffer
+    def __missing__(self, size):
+        array_type = self[size] = ctypes.c_char * size
+        return array_type
+
+
+_AUDIO_ARRAYS = _ArrayTypes()
+
+
 IQ = collections.namedtuple("IQ", ["data"])
 MER = collections.namedtuple("MER", ["lower", "upper"])
 BER = collections.namedtuple("BER", ["cber"])
@@ -330,20 +367,132 @@ class NRSC5Error(Exception):
     pass
 
 
+class _LazyEvent:
+    # SIG and SIS are repeated by the station with mostly unchanged content. The views below defer building the
+    # Python object graph until it is used, and offer a digest of the raw fields to tell whether anything changed.
+    # The underlying C structures are only valid during the callback; call materialize() to keep the content.
+    def __init__(self, radio, c_struct):
+        self._radio = radio
+        self._c_struct = c_struct
+        self._value = None
+        self._digest = None
+
+    def _check(self):
+        if self._c_struct is None:
+            raise NRSC5Error("Event accessed after its callback returned without being materialized.")
+
+    def _release(self):
+        self._c_struct = None
+        self._radio = None
+
+    @property
+    def digest(self):
+        if self._digest is None:
+            self._check()
+            self._digest = self._compute_digest()
+        return self._digest
+
+    def materialize(self):
+        if self._value is None:
+            self._check()
+            self._value = self._build()
+        return self._value
+
+
+class SIGView(_LazyEvent):
+    def _compute_digest(self):
+        fields = []
+        service_ptr = self._c_struct.services
+        while service_ptr:
+            service = service_ptr.contents
+            fields += (service.type, service.number, service.name)
+            component_ptr = service.components
+            while component_ptr:
+                component = component_ptr.contents
+                fields += (component.type, component.id)
+                if component.type == ComponentType.AUDIO.value:
+                    audio = component.u.audio
+                    fields += (audio.port, audio.type, audio.mime)
+                else:
+                    data = component.u.data
+                    fields += (data.port, data.service_data_type, data.type, data.mime)
+                component_ptr = component.next
+            service_ptr = service.next
+        return hash(tuple(fields))
+
+    def _build(self):
+        return self._radio._decode_sig(self._c_struct)
+
+    def __iter__(self):
+        return iter(self.materialize())
+
+    def __len__(self):
+        return len(self.materialize())
+
+    def __getitem__(self, index):
+        return self.materialize()[index]
+
+    def __eq__(self, other):
+        if isinstance(other, SIGView):
+            other = other.materialize()
+        return self.materialize() == other
+
+    __hash__ = None
+
+
+class SISView(_LazyEvent):
+    def _compute_digest(self):
+        sis = self._c_struct
+        address = ctypes.addressof(sis)
+        fields = [sis.country_code, sis.fcc_facility_id, sis.name, sis.slogan, sis.message, sis.alert,
+                  ctypes.string_at(address + _SIS.latitude.offset,
+                                   _SIS.altitude.offset + _SIS.altitude.size - _SIS.latitude.offset)]
+        audio_service_ptr = sis.audio_services
+        while audio_service_ptr:
+            fields.append(ctypes.string_at(ctypes.addressof(audio_service_ptr.contents) + _SISAudioService.program.offset,
+                                           ctypes.sizeof(_SISAudioService) - _SISAudioService.program.offset))
+            audio_service_ptr = audio_service_ptr.contents.next
+        data_service_ptr = sis.data_services
+        while data_service_ptr:
+            dsd = data_service_ptr.contents
+            fields += (dsd.access, dsd.type, dsd.mime_type)
+            data_service_ptr = dsd.next
+        return hash(tuple(fields))
+
+    def _build(self):
+        return self._radio._decode_sis(self._c_struct)
+
+    def __getattr__(self, name):
+        if name.startswith("__") or name in ("_radio", "_c_struct", "_value", "_digest"):
+            raise AttributeError(name)
+        return getattr(self.materialize(), name)
+
+    def __eq__(self, other):
+        if isinstance(other, SISView):
+            other = other.materialize()
+        return self.materialize() == other
+
+    __hash__ = None
+
+
 class NRSC5:
     libnrsc5 = None
 
+    @staticmethod
+    def library_name():
+        if os.environ.get("NRSC5_LIBRARY"):
+            return os.environ["NRSC5_LIBRARY"]
+        elif platform.system() == "Windows":
+            return "libnrsc5.dll"
+        elif platform.system() == "Linux":
+            return "libnrsc5.so"
+        elif platform.system() == "Darwin":
+            return "libnrsc5.dylib"
+        raise NRSC5Error("Unsupported platform: " + platform.system())
+
     def _load_library(self):
         if NRSC5.libnrsc5 is None:
-            if platform.system() == "Windows":
-                lib_name = "libnrsc5.dll"
-            elif platform.system() == "Linux":
-                lib_name = "libnrsc5.so"
-            elif platform.system() == "Darwin":
-                lib_name = "libnrsc5.dylib"
-            else:
-                raise NRSC5Error("Unsupported platform: " + platform.system())
-            NRSC5.libnrsc5 = ctypes.cdll.LoadLibrary(lib_name)
+            NRSC5.libnrsc5 = ctypes.cdll.LoadLibrary(NRSC5.library_name())
             self.radio = ctypes.c_void_p()
 
     @staticmethod
@@ -352,13 +501,64 @@ class NRSC5:
             return string
         return string.decode()
 
+    def _decode_sig(self, sig):
+        services = []
+        service_ptr = sig.services
+        while service_ptr:
+            service = service_ptr.contents
+            components = []
+            component_ptr = service.components
+            while component_ptr:
+                component = component_ptr.contents
+                component_type = _COMPONENT_TYPES[component.type]
+                if component_type == ComponentType.AUDIO:
+                    audio = SIGAudioComponent(component.u.audio.port, _PROGRAM_TYPES[component.u.audio.type],
+                                              _MIME_TYPES[component.u.audio.mime])
+                    components.append(SIGComponent(component_type, component.id, audio, None))
+                if component_type == ComponentType.DATA:
+                    data = SIGDataComponent(component.u.data.port,
+                                            _SERVICE_DATA_TYPES[component.u.data.service_data_type],
+                                            component.u.data.type, _MIME_TYPES[component.u.data.mime])
+                    components.append(SIGComponent(component_type, component.id, None, data))
+                component_ptr = component.next
+            services.append(SIGService(_SERVICE_TYPES[service.type], service.number,
+                                       self._decode(service.name), components))
+            service_ptr = service.next
+        return services
+
+    def _decode_sis(self, sis):
+        latitude, longitude, altitude = None, None, None
+        if not math.isnan(sis.latitude):
+            latitude, longitude, altitude = sis.latitude, sis.longitude, sis.altitude
+
+        audio_services = []
+        audio_service_ptr = sis.audio_services
+        while audio_service_ptr:
+            asd = audio_service_ptr.contents
+            audio_services.append(SISAudioService(asd.program, _ACCESS[asd.access],
+                                                  _PROGRAM_TYPES[asd.type], asd.sound_exp))
+            audio_service_ptr = asd.next
+
+        data_services = []
+        data_service_ptr = sis.data_services
+        while data_service_ptr:
+            dsd = data_service_ptr.contents
+            data_services.append(SISDataService(_ACCESS[dsd.access], _SERVICE_DATA_TYPES[dsd.type], dsd.mime_type))
+            data_service_ptr = dsd.next
+
+        return SIS(self._decode(sis.country_code), sis.fcc_facility_id, self._decode(sis.name),
+                   self._decode(sis.slogan), self._decode(sis.message), self._decode(sis.alert),
+                   latitude, longitude, altitude, audio_services, data_services)
+
     def _callback_wrapper(self, c_evt):
         c_evt = c_evt.contents
         evt = None
 
-        try:
-            evt_type = EventType(c_evt.event)
-        except ValueError:
+        if self._event_mask is not None and c_evt.event not in self._event_mask:
+            return
+
+        evt_type = _EVENT_TYPES.get(c_evt.event)
+        if evt_type is None:
             return
 
         if evt_type == EventType.IQ:
@@ -375,7 +575,12 @@ class NRSC5:
             evt = HDC(hdc.program, hdc.data[:hdc.count])
         elif evt_type == EventType.AUDIO:
             audio = c_evt.u.audio
-            evt = Audio(audio.program, audio.data[:audio.count * 2])
+            if self.audio_views and audio.count:
+                # libnrsc5's own buffer, so only valid until the callback returns
+                evt = Audio(audio.program,
+                            _AUDIO_ARRAYS[audio.count * 2].from_address(ctypes.addressof(audio.data.contents)))
+            else:
+                evt = Audio(audio.program, audio.data[:audio.count * 2])
         elif evt_type == EventType.ID3:
             id3 = c_evt.u.id3
 
@@ -385,69 +590,59 @@ class NRSC5:
 
             xhdr = None
             if id3.xhdr.mime != 0 or id3.xhdr.param != -1 or id3.xhdr.lot != -1:
-                xhdr = XHDR(None if id3.xhdr.mime == 0 else MIMEType(id3.xhdr.mime),
+                xhdr = XHDR(None if id3.xhdr.mime == 0 else _MIME_TYPES[id3.xhdr.mime],
                             None if id3.xhdr.param == -1 else id3.xhdr.param,
                             None if id3.xhdr.lot == -1 else id3.xhdr.lot)
 
             evt = ID3(id3.program, self._decode(id3.title), self._decode(id3.artist),
                       self._decode(id3.album), self._decode(id3.genre), ufid, xhdr)
         elif evt_type == EventType.SIG:
-            evt = []
-            service_ptr = c_evt.u.sig.services
-            while service_ptr:
-                service = service_ptr.contents
-                components = []
-                component_ptr = service.components
-                while component_ptr:
-                    component = component_ptr.contents
-                    component_type = ComponentType(component.type)
-                    if component_type == ComponentType.AUDIO:
-                        audio = SIGAudioComponent(component.u.audio.port, ProgramType(component.u.audio.type),
-                                                  MIMEType(component.u.audio.mime))
-                        components.append(SIGComponent(component_type, component.id, audio, None))
-                    if component_type == ComponentType.DATA:
-                        data = SIGDataComponent(component.u.data.port,
-                                                ServiceDataType(component.u.data.service_data_type),
-                                                component.u.data.type, MIMEType(component.u.data.mime))
-                        components.append(SIGComponent(component_type, component.id, None, data))
-                    component_ptr = component.next
-                evt.append(SIGService(ServiceType(service.type), service.number,
-                                      self._decode(service.name), components))
-                service_ptr = service.next
+            evt = SIGView(self, c_evt.u.sig)
         elif evt_type == EventType.LOT:
             lot = c_evt.u.lot
-            evt = LOT(lot.port, lot.lot, MIMEType(lot.mime), self._decode(lot.name), lot.data[:lot.size])
+            evt = LOT(lot.port, lot.lot, _MIME_TYPES[lot.mime], self._decode(lot.name), lot.data[:lot.size])
         elif evt_type == EventType.SIS:
-            sis = c_evt.u.sis
-
-            latitude, longitude, altitude = None, None, None
-            if not math.isnan(sis.latitude):
-                latitude, longitude, altitude = sis.latitude, sis.longitude, sis.altitude
-
-            audio_services = []
-            audio_service_ptr = sis.audio_services
-            while audio_service_ptr:
-                asd = audio_service_ptr.contents
-                audio_services.append(SISAudioService(asd.program, Access(asd.access),
-                                                      ProgramType(asd.type), asd.sound_exp))
-                audio_service_ptr = asd.next
-
-            data_services = []
-            data_service_ptr = sis.data_services
-            while data_service_ptr:
-                dsd = data_service_ptr.contents
-                data_services.append(SISDataService(Access(dsd.access), ServiceDataType(dsd.type), dsd.mime_type))
-                data_service_ptr = dsd.next
-
-            evt = SIS(self._decode(sis.country_code), sis.fcc_facility_id, self._decode(sis.name),
-                      self._decode(sis.slogan), self._decode(sis.message), self._decode(sis.alert),
-                      latitude, longitude, altitude, audio_services, data_services)
-        self.callback(evt_type, evt)
-
-    def __init__(self, callback):
+            evt = SISView(self, c_evt.u.sis)
+        try:
+            self.callback(evt_type, evt)
+        finally:
+            # even if the callback raised, libnrsc5 frees the structures once this returns
+            if isinstance(evt, _LazyEvent):
+                evt._release()
+
+    def __init__(self, callback, events=None, audio_views=False):
         self._load_library()
         self.radio = ctypes.c_void_p()
         self.callback = callback
+        # AUDIO data as a zero-copy view instead of bytes, for callbacks that copy it out before returning
+        self.audio_views = audio_views
+        self._event_mask = None
+        if events is not None:
+            self.set_events(events)
+
+    @staticmethod
+    def set_library(library):
+        # Replaces libnrsc5 with any object providing the same nrsc5_* functions, e.g. nrsc5fake.FakeLibrary.
+        NRSC5.libnrsc5 = library
+
+    @property
+    def events(self):
+        if self._event_mask is None:
+            return None
+        return {EventType(event) for event in self._event_mask}
+
+    def set_events(self, events):
+        # Events outside the mask are dropped before any decoding. None subscribes to everything.
+        self._event_mask = None if events is None else frozenset(event.value for event in events)
+
+    def subscribe(self, *events):
+        if self._event_mask is not None:
+            self._event_mask = self._event_mask.union(event.value for event in events)
+
+    def unsubscribe(self, *events):
+        if self._event_mask is None:
+            self._event_mask = frozenset(event.value for event in EventType)
+        self._event_mask = self._event_mask.difference(event.value for event in events)
 
     @staticmethod
     def get_version():
@@ -0,0 +1,453 @@
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import collections
+import math
+import threading
+import time
+import numpy
+
+RATE = 44100
+CHANNELS = 2
+BLOCK_FRAMES = 2048
+
+
+class AudioRingBuffer:
+
+    # Preallocated int16 frames for one program. Positions are absolute frame counts, so discarding is a
+    # single index move and reads can take any number of frames. The lock only guards index updates and
+    # the copies into or out of the ring, never a wait.
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.data = numpy.zeros((capacity, CHANNELS), numpy.int16)
+        self.lock = threading.Lock()
+        self.start = 0
+        self.end = 0
+        self.overruns = 0
+        # (end position, arrival time) of each write, oldest first
+        self.timestamps = collections.deque()
+
+    def __len__(self):
+        return self.end - self.start
+
+    def write(self, data, timestamp=None):
+        samples = numpy.frombuffer(data, numpy.int16).reshape(-1, CHANNELS)[-self.capacity:]
+        frames = len(samples)
+        with self.lock:
+            offset = self.end % self.capacity
+            first = min(frames, self.capacity - offset)
+            self.data[offset:offset + first] = samples[:first]
+            self.data[:frames - first] = samples[first:]
+            self.end += frames
+            if self.end - self.start > self.capacity:
+                self.overruns += self.end - self.capacity - self.start
+                self.start = self.end - self.capacity
+            self.timestamps.append((self.end, timestamp))
+            self._trimtimestamps()
+        return frames
+
+    def read(self, frames, out=None):
+        # copy up to frames of the oldest audio into out and return the filled part
+        return self._copy(frames, out, True)
+
+    def peek(self, frames, out=None):
+        # like read, but leaves the audio in the buffer
+        return self._copy(frames, out, False)
+
+    def _copy(self, frames, out, consume):
+        if out is None:
+            out = numpy.empty((frames, CHANNELS), numpy.int16)
+        with self.lock:
+            frames = min(frames, self.end - self.start, len(out))
+            offset = self.start % self.capacity
+            first = min(frames, self.capacity - offset)
+            out[:first] = self.data[offset:offset + first]
+            out[first:frames] = self.data[:frames - first]
+            if consume:
+                self.start += frames
+                self._trimtimestamps()
+        return out[:frames]
+
+    def align(self, position):
+        # move an empty buffer to position, so absolute positions line up with other programs' buffers
+        with self.lock:
+            if self.start == self.end:
+                self.start = self.end = position
+                self.timestamps.clear()
+
+    def discard_before(self, position):
+        # drop audio before the absolute position, returning how many frames were dropped
+        with self.lock:
+            dropped = max(0, min(position, self.end) - self.start)
+            self.start += dropped
+            self._trimtimestamps()
+        return dropped
+
+    def trim(self, frames):
+        # drop the oldest audio so that at most frames remain, returning how many were dropped
+        with self.lock:
+            dropped = max(0, self.end - self.start - frames)
+            self.start += dropped
+            self._trimtimestamps()
+        return dropped
+
+    def clear(self):
+        return self.trim(0)
+
+    def timestamp(self):
+        # arrival time of the oldest buffered frame
+        with self.lock:
+            for end, timestamp in self.timestamps:
+                if end > self.start:
+                    return timestamp
+        return None
+
+    def _trimtimestamps(self):
+        while self.timestamps and self.timestamps[0][0] <= self.start:
+            self.timestamps.popleft()
+
+
+class DriftController:
+
+    # The RTL-SDR and the sound card run off different clocks, so a buffer drained at the card's rate slowly
+    # fills or empties. drift estimates the offset in ppm as the long-run slope of frames arrived against frames
+    # played: a least squares fit, weighted to the last window seconds, that bursty arrivals average out of. It
+    # stays 0 until settle seconds have played. Blocks are stretched or squeezed by drift plus a small
+    # correction toward the target fill level, by at most maxppm either way.
+    def __init__(self, target, maxppm=1000, deadband=20, gain=0.01, smoothing=0.05, window=300.0, settle=60.0):
+        self.target = target
+        self.maxppm = maxppm
+        self.deadband = deadband
+        self.gain = gain
+        self.smoothing = smoothing
+        self.window = window * RATE
+        self.settle = settle * RATE
+        self.drift = 0.0
+        # frames arrived in and played from the buffer, and taken from it since the last update
+        self.arrived = 0
+        self.played = 0
+        self.taken = 0
+        # weight, means and co-moments of the (played, arrived) fit
+        self.weight = 0.0
+        self.meanplayed = 0.0
+        self.meanarrived = 0.0
+        self.varplayed = 0.0
+        self.covariance = 0.0
+        self.fitted = 0
+        self.reset()
+
+    def reset(self):
+        # after a gap, or for a buffer that isn't level with the last: the estimate stays, but the jump in
+        # fill isn't an arrival
+        self.level = None
+        self.fill = None
+        self.ppm = 0.0
+        self.phase = 0.0
+
+    def update(self, fill):
+        # call with the fill level before each read, and only when the read will be complete. across a
+        # reset the change in fill isn't arrivals, so what was taken meanwhile counts as replaced
+        self.arrived += self.taken
+        if self.fill is not None:
+            self.arrived += fill - self.fill
+        self.fit()
+        self.fill = fill
+        self.taken = 0
+        if self.level is None:
+            self.level = fill
+        self.level += self.smoothing * (fill - self.level)
+        correction = (self.level - self.target) / self.target * 1e6 * self.gain
+        if abs(correction) < self.deadband:
+            correction = 0.0
+        self.ppm = max(-self.maxppm, min(self.maxppm, self.drift + correction))
+
+    def fit(self):
+        decay = math.exp(-(self.played - self.fitted) / self.window)
+        self.fitted = self.played
+        self.weight = self.weight * decay + 1
+        self.varplayed *= decay
+        self.covariance *= decay
+        delta = self.played - self.meanplayed
+        self.meanplayed += delta / self.weight
+        self.meanarrived += (self.arrived - self.meanarrived) / self.weight
+        self.varplayed += delta * (self.played - self.meanplayed)
+        self.covariance += delta * (self.arrived - self.meanarrived)
+        if self.played >= self.settle and self.varplayed > 0:
+            drift = (self.covariance / self.varplayed - 1) * 1e6
+            self.drift = max(-self.maxppm, min(self.maxppm, drift))
+
+    def outputframes(self, frames):
+        # how many frames to play for frames taken from the buffer
+        exact = frames / (1 + self.ppm * 1e-6) + self.phase
+        played = int(exact)
+        self.phase = exact - played
+        self.taken += frames
+        self.played += played
+        return played
+
+    def inputframes(self, frames):
+        # how many frames to take from the buffer to play frames
+        exact = frames * (1 + self.ppm * 1e-6) + self.phase
+        taken = int(exact)
+        self.phase = exact - taken
+        self.taken += taken
+        self.played += frames
+        return taken
+
+    @staticmethod
+    def stretch(samples, frames):
+        # linear interpolation to frames, keeping the first and last frame in place
+        if len(samples) == frames or len(samples) < 2:
+            return samples
+        positions = numpy.linspace(0, len(samples) - 1, frames)
+        index = positions.astype(numpy.intp)
+        fraction = (positions - index)[:, None]
+        following = numpy.minimum(index + 1, len(samples) - 1)
+        result = samples[index] * (1 - fraction) + samples[following] * fraction
+        return numpy.rint(result).astype(numpy.int16)
+
+
+class GainRamp:
+
+    # Applies a gain that moves linearly from one value to another across a block, so level changes never
+    # step. The 1/n..n/n ramps are cached per block length and the scratch array is reused.
+    def __init__(self):
+        self.ramps = {}
+        self.scratch = numpy.empty(2 * BLOCK_FRAMES, numpy.float32)
+
+    def apply(self, work, start, end):
+        frames = len(work)
+        if start == end:
+            if start != 1:
+                work *= numpy.float32(start)
+            return
+        base = self.ramps.get(frames)
+        if base is None:
+            base = self.ramps[frames] = numpy.arange(1, frames + 1, dtype=numpy.float32) / frames
+        if frames > len(self.scratch):
+            self.scratch = numpy.empty(frames, numpy.float32)
+        ramp = self.scratch[:frames]
+        numpy.multiply(base, numpy.float32(end - start), out=ramp)
+        ramp += numpy.float32(start)
+        work *= ramp[:, None]
+
+
+class GainStage:
+
+    # The volume control. set() only records the target; the next block ramps to it.
+    def __init__(self, gain=1.0):
+        self.enabled = True
+        self.gain = gain
+        self.target = gain
+        self.ramp = GainRamp()
+
+    def set(self, gain):
+        self.target = gain
+
+    def process(self, work, program):
+        self.ramp.apply(work, self.gain, self.target)
+        self.gain = self.target
+
+
+class LoudnessNormalizer:
+
+    # Evens out levels between programs. Each program keeps a slow average of its block power, ignoring
+    # near silence, and gets the gain that brings it to target dBFS RMS, limited to maxgain dB either way.
+    # The averages survive program switches, so returning to a program picks up its learned level.
+    def __init__(self, target=-20.0, maxgain=12.0, gate=-50.0, smoothing=0.02):
+        self.enabled = False
+        self.target = 32768 * 10 ** (target / 20)
+        self.limit = 10 ** (maxgain / 20)
+        self.gate = (32768 * 10 ** (gate / 20)) ** 2
+        self.smoothing = smoothing
+        self.levels = {}
+        self.gains = {}
+        self.ramp = GainRamp()
+
+    def process(self, work, program):
+        flat = work.reshape(-1)
+        power = float(numpy.dot(flat, flat)) / len(flat) if len(flat) else 0
+        level = self.levels.get(program)
+        if power > self.gate:
+            level = power if level is None else level + self.smoothing * (power - level)
+            self.levels[program] = level
+        gain = self.gains.get(program, 1.0)
+        target = gain
+        if level:
+            target = min(self.limit, max(1 / self.limit, self.target / level ** 0.5))
+        self.ramp.apply(work, gain, target)
+        self.gains[program] = target
+
+
+class Limiter:
+
+    # Cheap peak limiter, off by default. If a block would go past threshold the gain ramps down to just fit
+    # it, reaching the new gain by the first frame that would overshoot, then recovers by release per block.
+    # Whatever still overshoots is clipped by the chain.
+    def __init__(self, threshold=0.9, release=0.05):
+        self.enabled = False
+        self.threshold = threshold * 32767
+        self.release = release
+        self.gain = 1.0
+        self.limited = 0
+        self.ramp = GainRamp()
+
+    def process(self, work, program):
+        peak = max(float(work.max(initial=0)), -float(work.min(initial=0)))
+        target = min(1.0, self.gain + self.release)
+        if peak * target > self.threshold:
+            target = self.threshold / peak
+            self.limited += 1
+        if target < self.gain:
+            over = numpy.abs(work).max(axis=1) * self.gain > self.threshold
+            if over.any():
+                first = int(over.argmax()) + 1
+                work[:first] *= numpy.linspace(self.gain, target, first + 1, dtype=numpy.float32)[1:, None]
+                work[first:] *= numpy.float32(target)
+                self.gain = target
+                return
+        self.ramp.apply(work, self.gain, target)
+        self.gain = target
+
+
+class Crossfade:
+
+    # Mixes the old program's next frames into the start of the new one after a program switch, fading the
+    # old out linearly over their length.
+    def __init__(self, frames=1024):
+        self.enabled = True
+        self.tail = numpy.zeros((frames, CHANNELS), numpy.float32)
+        self.scratch = numpy.empty((frames, CHANNELS), numpy.float32)
+        self.weights = None
+        self.length = 0
+        self.position = 0
+
+    def start(self, samples, gain=1.0):
+        frames = min(len(samples), len(self.tail))
+        self.tail[:frames] = samples[:frames]
+        if gain != 1:
+            self.tail[:frames] *= numpy.float32(gain)
+        self.weights = numpy.linspace(1, 0, frames, endpoint=False, dtype=numpy.float32)[:, None]
+        self.length = frames
+        self.position = 0
+
+    def process(self, work, program):
+        frames = min(len(work), self.length - self.position)
+        if frames <= 0:
+            return
+        end = self.position + frames
+        # new + (old - new) * weight
+        difference = self.scratch[:frames]
+        numpy.subtract(self.tail[self.position:end], work[:frames], out=difference)
+        difference *= self.weights[self.position:end]
+        work[:frames] += difference
+        self.position = end
+
+
+class AudioChain:
+
+    # Runs int16 blocks through a list of stages working in place on one float32 buffer. Each stage has
+    # enabled and process(work, program); stages can be added to or reordered in stages.
+    def __init__(self, stages=None):
+        self.gain = GainStage()
+        self.normalizer = LoudnessNormalizer()
+        self.limiter = Limiter()
+        self.crossfade = Crossfade()
+        self.stages = stages if stages is not None else [self.normalizer, self.crossfade, self.gain, self.limiter]
+        self.work = numpy.empty((2 * BLOCK_FRAMES, CHANNELS), numpy.float32)
+        # the latest switch() not yet picked up by process()
+        self.pending = collections.deque(maxlen=1)
+        self.blocks = 0
+        self.elapsed = 0
+
+    def switch(self, samples, program):
+        # samples are the old program's upcoming frames, to fade out under the start of the new program. any
+        # thread can call this; the crossfade starts on the audio thread, with the first block of another program
+        self.pending.append((samples, program))
+
+    def process(self, samples, program):
+        # samples is int16 frames and is overwritten with the result
+        start = time.perf_counter()
+        if self.pending and self.pending[0][1] != program:
+            tail, previous = self.pending.popleft()
+            gain = self.normalizer.gains.get(previous, 1.0) if self.normalizer.enabled else 1.0
+            self.crossfade.start(tail, gain)
+        frames = len(samples)
+        if frames > len(self.work):
+            self.work = numpy.empty((frames, CHANNELS), numpy.float32)
+        work = self.work[:frames]
+        work[:] = samples
+        for stage in self.stages:
+            if stage.enabled:
+                stage.process(work, program)
+        numpy.clip(work, -32768, 32767, out=work)
+        numpy.rint(work, out=work)
+        samples[:] = work
+        self.blocks += 1
+        self.elapsed += time.perf_counter() - start
+        return samples
+
+
+class PyAudioOutput:
+
+    pulls = False
+
+    def __init__(self, framesperbuffer=1024):
+        import pyaudio
+        self.audio = pyaudio.PyAudio()
+        try:
+            index = self.audio.get_default_output_device_info()["index"]
+            self.stream = self.audio.open(format=pyaudio.paInt16,
+                                          channels=CHANNELS,
+                                          rate=RATE,
+                                          frames_per_buffer=framesperbuffer,
+                                          output_device_index=index,
+                                          output=True)
+        except Exception:
+            self.audio.terminate()
+            raise
+
+    def write(self, samples):
+        self.stream.write(memoryview(samples).cast("B").toreadonly())
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
+
+
+class PyAudioCallbackOutput:
+
+    # PortAudio asks for fixed-size buffers at the sound card's own cadence and pull(out) fills them, so the
+    # decoder's bursty delivery never blocks on the device
+    pulls = True
+
+    def __init__(self, pull, framesperbuffer=1024):
+        import pyaudio
+        self.pyaudio = pyaudio
+        self.pull = pull
+        self.buffer = numpy.zeros((framesperbuffer, CHANNELS), numpy.int16)
+        self.audio = pyaudio.PyAudio()
+        try:
+            index = self.audio.get_default_output_device_info()["index"]
+            self.stream = self.audio.open(format=pyaudio.paInt16,
+                                          channels=CHANNELS,
+                                          rate=RATE,
+                                          frames_per_buffer=framesperbuffer,
+                                          output_device_index=index,
+                                          output=True,
+                                          stream_callback=self.callback)
+        except Exception:
+            self.audio.terminate()
+            raise
+
+    def callback(self, in_data, frame_count, time_info, status):
+        if frame_count > len(self.buffer):
+            self.buffer = numpy.zeros((frame_count, CHANNELS), numpy.int16)
+        samples = self.pull(self.buffer[:frame_count])
+        return memoryview(samples).cast("B").toreadonly(), self.pyaudio.paContinue
+
+    def close(self):
+        self.stream.stop_stream()
+        self.stream.close()
+        self.audio.terminate()
@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import argparse
+import concurrent.futures
+import enum
+import json
+import logging
+import os
+import sys
+import time
+import wave
+import nrsc5
+import nrsc5iq
+
+EVENTS = {
+    nrsc5.EventType.AUDIO,
+    nrsc5.EventType.ID3,
+    nrsc5.EventType.LOT,
+    nrsc5.EventType.SIS
+}
+
+# one libnrsc5 instance per worker process, reused for every file it decodes
+_radio = None
+
+
+def jsonable(value):
+    if isinstance(value, nrsc5.Unknown):
+        return value.value
+    if isinstance(value, enum.Enum):
+        return value.name
+    if hasattr(value, "_asdict"):
+        return {key: jsonable(item) for key, item in value._asdict().items()}
+    if isinstance(value, (list, tuple)):
+        return [jsonable(item) for item in value]
+    return value
+
+
+class BatchDecoder:
+
+    def __init__(self, path, outdir, iqformat):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        # a.cu8 and a.cs16 are different recordings, so the extension stays in the directory name
+        self.outdir = os.path.join(outdir, os.path.basename(path))
+        self.iqformat = iqformat
+        self.reader = None
+        self.wavefiles = {}
+        self.frames = {}
+        self.lots = 0
+        self.sisdigest = None
+        self.log = None
+
+    def timestamp(self):
+        return round(self.reader.position / self.reader.byterate, 3)
+
+    def writeevent(self, evt_type, fields):
+        fields = dict(fields, type=evt_type.name, time=self.timestamp())
+        self.log.write(json.dumps(fields) + "\n")
+
+    def callback(self, evt_type, evt):
+        if evt_type == nrsc5.EventType.AUDIO:
+            wavefile = self.wavefiles.get(evt.program)
+            if wavefile is None:
+                path = os.path.join(self.outdir, "%s-HD%d.wav" % (self.name, evt.program + 1))
+                wavefile = wave.open(path, "wb")
+                wavefile.setnchannels(2)
+                wavefile.setsampwidth(2)
+                wavefile.setframerate(44100)
+                self.wavefiles[evt.program] = wavefile
+                self.frames[evt.program] = 0
+            wavefile.writeframes(evt.data)
+            self.frames[evt.program] += len(evt.data) // 4
+        elif evt_type == nrsc5.EventType.ID3:
+            self.writeevent(evt_type, jsonable(evt))
+        elif evt_type == nrsc5.EventType.SIS:
+            if evt.digest != self.sisdigest:
+                self.sisdigest = evt.digest
+                self.writeevent(evt_type, jsonable(evt.materialize()))
+        elif evt_type == nrsc5.EventType.LOT:
+            lotdir = os.path.join(self.outdir, "lot")
+            os.makedirs(lotdir, exist_ok=True)
+            filename = "%d-%s" % (evt.lot, os.path.basename(evt.name or "unnamed"))
+            with open(os.path.join(lotdir, filename), "wb") as file:
+                file.write(evt.data)
+            self.lots += 1
+            self.writeevent(evt_type, {"port": evt.port, "lot": evt.lot, "mime": jsonable(evt.mime),
+                                       "name": evt.name, "size": len(evt.data), "file": filename})
+
+    def run(self, radio):
+        try:
+            self.reader = nrsc5iq.IQFileReader(radio, self.path, self.iqformat, realtime=False)
+            os.makedirs(self.outdir, exist_ok=True)
+            self.log = open(os.path.join(self.outdir, self.name + ".jsonl"), "w")
+            radio.callback = self.callback
+            radio.open_pipe()
+            try:
+                radio.start()
+                self.reader.run()
+            finally:
+                radio.stop()
+                radio.close()
+        finally:
+            for wavefile in self.wavefiles.values():
+                wavefile.close()
+            if self.log is not None:
+                self.log.close()
+        return {
+            "file": self.path,
+            "duration": self.reader.duration,
+            "elapsed": self.reader.elapsed,
+            "speed": self.reader.speed,
+            "audio": {program + 1: frames / 44100 for program, frames in self.frames.items()},
+            "lots": self.lots
+        }
+
+
+def initworker():
+    global _radio
+    if os.name == "nt":
+        os.add_dll_directory(os.getcwd())
+    _radio = nrsc5.NRSC5(None, events=EVENTS)
+
+
+def decodefile(path, outdir, iqformat):
+    return BatchDecoder(path, outdir, iqformat).run(_radio)
+
+
+def iqformat(path, default):
+    extension = os.path.splitext(path)[1].lower()[1:]
+    return extension if extension in nrsc5iq.SAMPLE_RATES else default
+
+
+def findfiles(paths, extensions):
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if os.path.splitext(name)[1].lower() in extensions:
+                    files.append(os.path.join(path, name))
+        else:
+            files.append(path)
+    return files
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Decode recorded IQ files to per-program audio and event logs.")
+    parser.add_argument("inputs", nargs="+", help="IQ files or directories of IQ files")
+    parser.add_argument("-o", "--output", default="decoded", help="output directory")
+    parser.add_argument("-f", "--format", choices=sorted(nrsc5iq.SAMPLE_RATES), default="cu8",
+                        help="IQ sample format, unless given by a .cu8 or .cs16 extension")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="worker processes")
+    parser.add_argument("--extensions", default=".cu8,.iq,.raw,.bin,.cs16",
+                        help="file extensions picked up from directories")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=20, format="%(asctime)s %(message)s", datefmt="%H:%M:%S")
+    files = findfiles(args.inputs, set(args.extensions.lower().split(",")))
+    if not files:
+        logging.info("No IQ files found")
+        return 1
+
+    failed = 0
+    duration = 0
+    start = time.monotonic()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs, initializer=initworker) as executor:
+        futures = {executor.submit(decodefile, path, args.output, iqformat(path, args.format)): path
+                   for path in files}
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as ex:
+                failed += 1
+                logging.info("%s failed: %s: %s", futures[future], type(ex).__name__, ex)
+                continue
+            duration += result["duration"]
+            logging.info("%s: %.1f s of IQ in %.1f s (%.2fx real time), programs %s, %d LOT files",
+                         result["file"], result["duration"], result["elapsed"], result["speed"],
+                         ", ".join("HD%d %.0f s" % item for item in sorted(result["audio"].items())),
+                         result["lots"])
+    elapsed = time.monotonic() - start
+    logging.info("Decoded %d of %d files, %.1f s of IQ in %.1f s (%.2fx real time overall)",
+                 len(files) - failed, len(files), duration, elapsed, duration / elapsed if elapsed else 0)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,397 @@
+#!/usr/bin/env python3
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import argparse
+import ctypes
+import gc
+import json
+import math
+import platform
+import subprocess
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+import numpy
+import nrsc5
+import nrsc5audio
+import nrsc5fake
+import nrsc5service
+import nrsc5sink
+
+
+def decodecases():
+    # name, event, whether the consumer builds the full object graph from lazy views
+    block = nrsc5fake.tone(0)
+    return [
+        ("audio", nrsc5fake.audioevent(0, block), False),
+        ("audio-view", nrsc5fake.audioevent(0, block), False),
+        ("iq", nrsc5fake.iqevent(bytes(32768)), False),
+        ("hdc", nrsc5fake.hdcevent(0, bytes(512)), False),
+        ("id3", nrsc5fake.id3event(0, "Title", "Artist", 16), False),
+        ("sig", nrsc5fake.sigevent(4, 2, 1), True),
+        ("sig-digest", nrsc5fake.sigevent(4, 2, 1), False),
+        ("sig-large", nrsc5fake.sigevent(4, 32, 16), True),
+        ("sig-large-digest", nrsc5fake.sigevent(4, 32, 16), False),
+        ("sis", nrsc5fake.sisevent("FAKE", "Synthetic Radio", 4, 1), True),
+        ("sis-large", nrsc5fake.sisevent("FAKE", "Synthetic Radio", 64, 64), True),
+        ("sis-large-digest", nrsc5fake.sisevent("FAKE", "Synthetic Radio", 64, 64), False),
+        ("lot", nrsc5fake.lotevent(0x1000, 1, nrsc5.MIMEType.PNG, "logo.png", bytes(65536)), False),
+        ("mer", nrsc5fake.merevent(12.5, 13.0), False),
+        ("ber", nrsc5fake.berevent(0.001), False),
+        ("sync", nrsc5fake.simpleevent(nrsc5.EventType.SYNC), False),
+        ("lost-sync", nrsc5fake.simpleevent(nrsc5.EventType.LOST_SYNC), False),
+        ("lost-device", nrsc5fake.simpleevent(nrsc5.EventType.LOST_DEVICE), False),
+    ]
+
+
+def consumer(materialize, keep=None):
+    def callback(evt_type, evt):
+        if hasattr(evt, "digest"):
+            evt.digest
+            if materialize:
+                evt = evt.materialize()
+        if keep is not None:
+            keep.append(evt)
+    return callback
+
+
+def benchdecode(name, evt, materialize, count, repeat):
+    radio = nrsc5.NRSC5(consumer(materialize), audio_views=name == "audio-view")
+    pointer = ctypes.pointer(evt)
+    wrapper = radio._callback_wrapper
+
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter_ns()
+        for _ in range(count):
+            wrapper(pointer)
+        elapsed = time.perf_counter_ns() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    # keep every decoded event alive, so the memory they hold is counted
+    keep = []
+    radio.callback = consumer(materialize, keep)
+    gc.collect()
+    gc.disable()
+    blocks = sys.getallocatedblocks()
+    tracemalloc.start()
+    for _ in range(count):
+        wrapper(pointer)
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    blocks = sys.getallocatedblocks() - blocks
+    gc.enable()
+    del keep
+
+    return {
+        "name": name,
+        "events": count,
+        "ns_per_event": best / count,
+        "blocks_per_event": blocks / count,
+        "bytes_per_event": size / count,
+    }
+
+
+class NullOutput:
+
+    # consumes audio at the sound card rate (scaled by speed) without playing it. like a sound card, it plays
+    # silence while it has nothing, rather than catching up later
+    pulls = False
+
+    def __init__(self, speed, sdrppm=0):
+        # sdrppm makes the broadcast run that much faster than this clock
+        self.rate = 44100 * speed / (1 + sdrppm * 1e-6) if speed else None
+        self.frames = 0
+        self.start = None
+        self.gaps = 0
+
+    def write(self, samples):
+        if self.rate:
+            now = time.monotonic()
+            # a late wakeup isn't starvation, only falling more than a few blocks behind is. a pulling
+            # output is never starved, pullaudio fills in silence itself
+            if self.start is None or not self.pulls and \
+                    now - self.start > (self.frames + 8 * nrsc5audio.BLOCK_FRAMES) / self.rate:
+                self.gaps += self.start is not None
+                self.start = now - self.frames / self.rate
+        self.frames += len(samples)
+        if self.rate:
+            ahead = self.frames / self.rate - (time.monotonic() - self.start)
+            if ahead > 0:
+                time.sleep(ahead)
+
+    def close(self):
+        pass
+
+
+class NullCallbackOutput(NullOutput):
+
+    # pulls fixed-size buffers from its own thread, like a PortAudio callback stream
+    pulls = True
+
+    def __init__(self, speed, pull, framesperbuffer, sdrppm=0):
+        super().__init__(speed, sdrppm)
+        self.pull = pull
+        self.buffer = numpy.zeros((framesperbuffer, nrsc5audio.CHANNELS), numpy.int16)
+        self.running = True
+        self.thread = threading.Thread(target=self.worker)
+        self.thread.start()
+
+    def worker(self):
+        while self.running:
+            self.write(self.pull(self.buffer))
+
+    def close(self):
+        self.running = False
+        self.thread.join()
+
+
+class BenchService(nrsc5service.NRSC5service):
+
+    def __init__(self, speed, sdrppm=0):
+        super().__init__()
+        self.speed = speed
+        self.sdrppm = sdrppm
+        self.output = None
+        self.cachelogos = False
+        self.frequency = 90.1
+
+    def openoutput(self):
+        if self.audiomode == "callback":
+            self.output = NullCallbackOutput(self.speed, self.pullaudio, self.framesperbuffer, self.sdrppm)
+        else:
+            self.output = NullOutput(self.speed, self.sdrppm)
+        return self.output
+
+
+class SlowSink(nrsc5sink.NullSink):
+
+    # takes longer than real time per block, so it falls behind and gets detached. its short queue fills in
+    # well under a second
+    def __init__(self, queuesize=8):
+        super().__init__(queuesize)
+        self.detached = False
+
+    def write(self, program, samples, timestamp):
+        time.sleep(2 * len(samples) / nrsc5audio.RATE)
+
+    def detach(self):
+        self.detached = True
+        super().detach()
+
+
+def percentile(values, p):
+    # nearest rank
+    if not values:
+        return 0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, max(0, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+def benchservice(bufferlength, bufferthresh, seconds, speed, mode, latency, volume=1.0, normalize=False,
+                 limit=False, switch=None, warm=True, fanout=0, slowsink=False, adaptive=True, sdrppm=0):
+    library = nrsc5fake.install(speed=speed)
+    service = BenchService(speed, sdrppm)
+    service.bufferlength = bufferlength
+    service.bufferthresh = bufferthresh
+    service.audiomode = mode
+    if latency:
+        service.targetlatency = latency
+    service.setvolume(volume)
+    service.dsp.normalizer.enabled = normalize
+    service.dsp.limiter.enabled = limit
+    service.warmswitch = warm
+    service.adaptive = adaptive
+    sinks = [service.addsink(program, nrsc5sink.NullSink()) for program in range(4) for _ in range(fanout)]
+    slow = service.addsink(0, SlowSink()) if slowsink else None
+
+    # (seconds since start, blocks buffered for the current program), every 50 ms
+    depths = []
+    sampling = threading.Event()
+
+    def sampler():
+        # also steps through the programs every switch seconds
+        nextswitch = time.monotonic() + switch if switch else None
+        while not sampling.wait(0.05):
+            depths.append((round(time.monotonic() - start, 3),
+                           len(service.audio_buffers[service.program]) / nrsc5audio.BLOCK_FRAMES))
+            if nextswitch and time.monotonic() >= nextswitch and service.programs:
+                programs = sorted(service.programs)
+                following = programs[(programs.index(service.program) + 1) % len(programs)] \
+                    if service.program in programs else programs[0]
+                service.setprogram(following)
+                nextswitch += switch
+
+    cpu = time.process_time()
+    start = time.monotonic()
+    service.run()
+    thread = threading.Thread(target=sampler)
+    thread.start()
+    time.sleep(seconds)
+    sampling.set()
+    thread.join()
+    service.stop()
+    elapsed = time.monotonic() - start
+    cpu = time.process_time() - cpu
+
+    levels = [depth for timestamp, depth in depths]
+    stats = service.stats
+    audio = service.output.frames / 44100 if service.output else 0
+    return {
+        "bufferlength": bufferlength,
+        "bufferthresh": bufferthresh,
+        "mode": mode,
+        "volume": volume,
+        "normalize": normalize,
+        "limit": limit,
+        "warm_switch": warm,
+        "adaptive": adaptive,
+        "sdr_ppm": sdrppm,
+        "target_latency": service.targetlatency,
+        "seconds": elapsed,
+        "events_per_second": library.events / elapsed,
+        "audio_seconds": audio,
+        "cpu_per_audio_second": cpu / audio if audio else None,
+        "worker_cpu_percent": 100 * stats["workercpu"] / elapsed,
+        "queue_depth_mean": statistics.mean(levels) if levels else 0,
+        "queue_depth_max": max(levels, default=0),
+        "queue_depth_percentiles": {"p%d" % p: percentile(levels, p) for p in (1, 5, 50, 95, 99)},
+        "queue_depth_samples": depths,
+        "written_frames": stats["written"],
+        "discarded_frames": stats["discarded"],
+        "dropped_frames": stats["dropped"],
+        "overrun_frames": stats["overruns"],
+        "underruns": stats["underruns"],
+        "output_gaps": service.output.gaps if service.output else 0,
+        "latency_mean": stats["latencytotal"] / stats["latencycount"] if stats["latencycount"] else None,
+        "latency_max": stats["latencymax"],
+        "drift_ppm": stats["driftppm"],
+        "sinks": len(sinks),
+        "sink_blocks": sum(sink.blocks for sink in sinks),
+        "sink_dropped": sum(sink.dropped for sink in sinks),
+        "sinks_detached": service.sinks.detached,
+        "slow_sink_detached": slow.detached if slow else None,
+        "callbacks": stats["callbacks"],
+        "callback_us_mean": 1e6 * stats["callbacktime"] / stats["callbacks"] if stats["callbacks"] else None,
+        "callback_ms_max": 1000 * stats["callbackmax"],
+        "callbacks_over_budget": stats["overbudget"],
+        "callback_types": {name: {"count": count, "us_mean": 1e6 * elapsed / count, "ms_max": 1000 * longest,
+                                  "over_budget": over}
+                           for name, (count, elapsed, longest, over) in service.callbackstats.items()},
+        "background_dropped": service.executor.dropped,
+        "cache": service.cache.stats(),
+        "switches": stats["switches"],
+        "switch_latency_mean": stats["switchlatencytotal"] / stats["switches"] if stats["switches"] else None,
+        "switch_latency_max": stats["switchlatencymax"],
+        "dsp_blocks": service.dsp.blocks,
+        "dsp_us_per_block": 1e6 * service.dsp.elapsed / service.dsp.blocks if service.dsp.blocks else None,
+    }
+
+
+def service(args):
+    results = []
+    for setting in args.sweep.split(","):
+        bufferlength, bufferthresh = (int(value) for value in setting.split(":"))
+        result = benchservice(bufferlength, bufferthresh, args.seconds, args.speed, args.mode, args.latency,
+                              args.volume, args.normalize, args.limit,
+                              args.switch, not args.cold, args.fanout, args.slowsink, not args.fixed, args.sdr_ppm)
+        results.append(result)
+        if result["sinks"] or result["sinks_detached"]:
+            print("%d sinks: %d blocks, dropped %d, %d detached" % (
+                result["sinks"], result["sink_blocks"], result["sink_dropped"], result["sinks_detached"]),
+                file=sys.stderr)
+        if result["slow_sink_detached"] is False:
+            print("slow sink was never detached", file=sys.stderr)
+        if result["switches"]:
+            print("%d switches, latency %.3f s (max %.3f s)" % (
+                result["switches"], result["switch_latency_mean"], result["switch_latency_max"]), file=sys.stderr)
+        print("%4d/%-3d %8.0f events/s %6.3f cpu/s worker %4.1f%% depth %5.1f (p5 %.1f, p95 %.1f, max %.1f) dropped %d overruns %d underruns %d "
+              "latency %.3f s (max %.3f s) drift %+.0f ppm dsp %.1f us/block" % (
+                  bufferlength, bufferthresh, result["events_per_second"], result["cpu_per_audio_second"] or 0,
+                  result["worker_cpu_percent"],
+                  result["queue_depth_mean"], result["queue_depth_percentiles"]["p5"],
+                  result["queue_depth_percentiles"]["p95"], result["queue_depth_max"], result["dropped_frames"],
+                  result["overrun_frames"], result["underruns"],
+                  result["latency_mean"] or 0, result["latency_max"], result["drift_ppm"],
+                  result["dsp_us_per_block"] or 0), file=sys.stderr)
+    return results
+
+
+def commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except Exception:
+        return None
+
+
+def writeresults(results, output):
+    text = json.dumps(results, indent=2)
+    if output:
+        with open(output, "w") as file:
+            file.write(text + "\n")
+    else:
+        print(text)
+
+
+def decode(args):
+    nrsc5fake.install()
+    results = []
+    for name, evt, materialize in decodecases():
+        if args.only and name not in args.only:
+            continue
+        result = benchdecode(name, evt, materialize, args.count, args.repeat)
+        results.append(result)
+        print("%-18s %10.0f ns/event %8.1f blocks/event %10.0f bytes/event" % (
+            name, result["ns_per_event"], result["blocks_per_event"], result["bytes_per_event"]),
+            file=sys.stderr)
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="NRSC5 player benchmarks")
+    parser.add_argument("-o", "--output", help="write JSON results here instead of stdout")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    decodeparser = commands.add_parser("decode", help="time NRSC5._callback_wrapper per event type")
+    decodeparser.add_argument("-n", "--count", type=int, default=2000, help="events per measurement")
+    decodeparser.add_argument("-r", "--repeat", type=int, default=5, help="measurements, best is kept")
+    decodeparser.add_argument("--only", nargs="*", help="case names to run")
+    decodeparser.set_defaults(run=decode)
+
+    serviceparser = commands.add_parser("service", help="drive NRSC5service from the fake library into a null sink")
+    serviceparser.add_argument("-s", "--seconds", type=float, default=10, help="run time per setting")
+    serviceparser.add_argument("--speed", type=float, default=1.0, help="broadcast and sink pace, 1 is real time")
+    serviceparser.add_argument("--sweep", default="256:32,128:32,128:16,64:16,64:8",
+                               help="comma separated bufferlength:bufferthresh settings")
+    serviceparser.add_argument("--mode", choices=["blocking", "callback"], default="blocking",
+                               help="audio output mode")
+    serviceparser.add_argument("--latency", type=float, help="target latency in seconds")
+    serviceparser.add_argument("--volume", type=float, default=1.0, help="gain stage setting")
+    serviceparser.add_argument("--normalize", action="store_true", help="enable the loudness normalizer")
+    serviceparser.add_argument("--limit", action="store_true", help="enable the peak limiter")
+    serviceparser.add_argument("--switch", type=float, help="switch to the next program every this many seconds")
+    serviceparser.add_argument("--cold", action="store_true", help="cull inactive programs instead of warm switching")
+    serviceparser.add_argument("--fixed", action="store_true", help="no drift compensation")
+    serviceparser.add_argument("--sdr-ppm", type=float, default=0, help="broadcast clock offset from the sound card's")
+    serviceparser.add_argument("--fanout", type=int, default=0, help="null sinks to attach to every program")
+    serviceparser.add_argument("--slowsink", action="store_true", help="attach a sink that falls behind")
+    serviceparser.set_defaults(run=service)
+
+    args = parser.parse_args(argv)
+    results = {
+        "benchmark": args.command,
+        "commit": commit(),
+        "python": platform.python_version(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "results": args.run(args),
+    }
+    writeresults(results, args.output)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,97 @@
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import collections
+import threading
+
+
+class ByteBudgetCache:
+
+    # Holds bytes values (album art, logos, other LOT files) within a total size budget, evicting the least
+    # recently used first. Pinned keys are never evicted, even if that leaves the cache over budget; a key can
+    # be pinned before its value arrives. Safe to use from the callback and worker threads at once.
+    def __init__(self, budget=16 << 20):
+        self.budget = budget
+        self.lock = threading.Lock()
+        self.items = collections.OrderedDict()
+        self.pinned = set()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        with self.lock:
+            value = self.items.get(key)
+            if value is None:
+                self.misses += 1
+                return default
+            self.items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            if key in self.items:
+                self.size -= len(self.items.pop(key))
+            self.items[key] = value
+            self.size += len(value)
+            self._evict()
+
+    def pop(self, key):
+        with self.lock:
+            value = self.items.pop(key, None)
+            if value is not None:
+                self.size -= len(value)
+            return value
+
+    def pin(self, *keys):
+        with self.lock:
+            self.pinned.update(keys)
+
+    def unpin(self, *keys):
+        with self.lock:
+            self.pinned.difference_update(keys)
+            self._evict()
+
+    def repin(self, *keys):
+        # replace every pin with keys, skipping None
+        with self.lock:
+            self.pinned = {key for key in keys if key is not None}
+            self._evict()
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.pinned.clear()
+            self.size = 0
+
+    def _evict(self):
+        if self.size <= self.budget:
+            return
+        for key in list(self.items):
+            if key in self.pinned:
+                continue
+            self.size -= len(self.items.pop(key))
+            self.evictions += 1
+            if self.size <= self.budget:
+                return
+
+    def stats(self):
+        with self.lock:
+            return {
+                "items": len(self.items),
+                "bytes": self.size,
+                "budget": self.budget,
+                "pinned": len(self.pinned),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
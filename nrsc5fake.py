@@ -0,0 +1,372 @@
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import array
+import ctypes
+import math
+import struct
+import threading
+import time
+import zlib
+import nrsc5
+
+AUDIO_RATE = 44100
+BLOCK_FRAMES = 2048
+
+
+def png(width, height, rgb):
+    # smallest valid image we can hand to the album art and traffic paths
+    def chunk(kind, data):
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data))
+    row = b"\x00" + bytes(rgb) * width
+    return (b"\x89PNG\r\n\x1a\n"
+            + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(row * height))
+            + chunk(b"IEND", b""))
+
+
+def tone(program, frames=BLOCK_FRAMES):
+    # one block of interleaved stereo int16, a different pitch for each program
+    frequency = 220 * (program + 1)
+    samples = array.array("h")
+    for frame in range(frames):
+        value = int(8000 * math.sin(2 * math.pi * frequency * frame / AUDIO_RATE))
+        samples.extend((value, value))
+    return samples.tobytes()
+
+
+def _buffer(data):
+    buffer = ctypes.create_string_buffer(data, len(data))
+    return ctypes.cast(buffer, ctypes.POINTER(ctypes.c_char)), buffer
+
+
+def audioevent(program, data):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.AUDIO.value
+    evt.u.audio.program = program
+    evt.u.audio.data, evt.keep = _buffer(data)
+    evt.u.audio.count = len(data) // 2
+    return evt
+
+
+def iqevent(data):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.IQ.value
+    evt.u.iq.data, evt.keep = _buffer(data)
+    evt.u.iq.count = len(data)
+    return evt
+
+
+def merevent(lower, upper):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.MER.value
+    evt.u.mer.lower = lower
+    evt.u.mer.upper = upper
+    return evt
+
+
+def berevent(cber):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.BER.value
+    evt.u.ber.cber = cber
+    return evt
+
+
+def hdcevent(program, data):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.HDC.value
+    evt.u.hdc.program = program
+    evt.u.hdc.data, evt.keep = _buffer(data)
+    evt.u.hdc.count = len(data)
+    return evt
+
+
+def id3event(program, title, artist, lot=-1):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.ID3.value
+    id3 = evt.u.id3
+    id3.program = program
+    id3.title = title.encode("latin-1")
+    id3.artist = artist.encode("latin-1")
+    id3.album = b"Album"
+    id3.genre = None
+    id3.xhdr.mime = nrsc5.MIMEType.PRIMARY_IMAGE.value if lot >= 0 else 0
+    id3.xhdr.param = -1
+    id3.xhdr.lot = lot
+    return evt
+
+
+def sigevent(programs, components=2, dataservices=1):
+    # audio services carry an audio component plus logo and image ports; extra data services follow
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.SIG.value
+    keep = []
+    services = []
+    for program in range(programs):
+        service = nrsc5._SIGService(type=nrsc5.ServiceType.AUDIO.value, number=program + 1,
+                                    name=("HD%d" % (program + 1)).encode())
+        audio = nrsc5._SIGComponent(type=nrsc5.ComponentType.AUDIO.value, id=0)
+        audio.u.audio.port = program
+        audio.u.audio.type = nrsc5.ProgramType.ROCK.value
+        audio.u.audio.mime = nrsc5.MIMEType.HDC.value
+        nodes = [audio]
+        mimes = [nrsc5.MIMEType.STATION_LOGO, nrsc5.MIMEType.PRIMARY_IMAGE]
+        for index in range(components):
+            data = nrsc5._SIGComponent(type=nrsc5.ComponentType.DATA.value, id=index + 1)
+            data.u.data.port = logoport(program) if index == 0 else imageport(program) + index - 1
+            data.u.data.service_data_type = nrsc5.ServiceDataType.AUDIO_RELATED_DATA.value
+            data.u.data.type = 0
+            data.u.data.mime = mimes[min(index, 1)].value
+            nodes.append(data)
+        for node, following in zip(nodes, nodes[1:]):
+            node.next = ctypes.pointer(following)
+        service.components = ctypes.pointer(nodes[0])
+        keep += nodes
+        services.append(service)
+    for index in range(dataservices):
+        service = nrsc5._SIGService(type=nrsc5.ServiceType.DATA.value, number=0x100 + index, name=b"Data")
+        data = nrsc5._SIGComponent(type=nrsc5.ComponentType.DATA.value, id=0)
+        data.u.data.port = 0x3000 + index
+        data.u.data.service_data_type = nrsc5.ServiceDataType.TRAFFIC.value
+        data.u.data.mime = nrsc5.MIMEType.TTN_STM_TRAFFIC.value
+        service.components = ctypes.pointer(data)
+        keep.append(data)
+        services.append(service)
+    for service, following in zip(services, services[1:]):
+        service.next = ctypes.pointer(following)
+    if services:
+        evt.u.sig.services = ctypes.pointer(services[0])
+    evt.keep = keep + services
+    return evt
+
+
+def sisevent(name, slogan, audioservices=4, dataservices=1):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.SIS.value
+    sis = evt.u.sis
+    sis.country_code = b"US"
+    sis.fcc_facility_id = 12345
+    sis.name = name.encode()
+    sis.slogan = slogan.encode()
+    sis.message = None
+    sis.alert = None
+    sis.latitude = 40.0
+    sis.longitude = -75.0
+    sis.altitude = 100
+    audio = [nrsc5._SISAudioService(program=program, access=nrsc5.Access.PUBLIC.value,
+                                    type=nrsc5.ProgramType.ROCK.value, sound_exp=0)
+             for program in range(audioservices)]
+    data = [nrsc5._SISDataService(access=nrsc5.Access.PUBLIC.value, type=nrsc5.ServiceDataType.TRAFFIC.value,
+                                  mime_type=nrsc5.MIMEType.TTN_STM_TRAFFIC.value)
+            for index in range(dataservices)]
+    for nodes in (audio, data):
+        for node, following in zip(nodes, nodes[1:]):
+            node.next = ctypes.pointer(following)
+    if audio:
+        sis.audio_services = ctypes.pointer(audio[0])
+    if data:
+        sis.data_services = ctypes.pointer(data[0])
+    evt.keep = audio + data
+    return evt
+
+
+def lotevent(port, lot, mime, name, data):
+    evt = nrsc5._Event()
+    evt.event = nrsc5.EventType.LOT.value
+    evt.u.lot.port = port
+    evt.u.lot.lot = lot
+    evt.u.lot.size = len(data)
+    evt.u.lot.mime = mime.value
+    evt.u.lot.name = name.encode()
+    evt.u.lot.data, evt.keep = _buffer(data)
+    return evt
+
+
+def simpleevent(evt_type):
+    evt = nrsc5._Event()
+    evt.event = evt_type.value
+    return evt
+
+
+def logoport(program):
+    return 0x1000 + program
+
+
+def imageport(program):
+    return 0x2000 + program
+
+
+class FakeLibrary:
+
+    # Stands in for libnrsc5 behind NRSC5.set_library. A started radio emits a synthetic broadcast from its own
+    # thread: audio blocks for every program, plus periodic ID3, SIG, SIS and LOT. speed scales the pace, None
+    # runs unthrottled. Piped samples instead advance the stream clock synchronously.
+    def __init__(self, programs=4, speed=1.0, id3interval=10.0, siginterval=1.0, lotinterval=5.0,
+                 iq=False, hdc=False, station="FAKE", slogan="Synthetic Radio", sigcomponents=2):
+        self.programs = programs
+        self.speed = speed
+        self.id3interval = id3interval
+        self.siginterval = siginterval
+        self.lotinterval = lotinterval
+        self.iq = iq
+        self.hdc = hdc
+        self.station = station
+        self.slogan = slogan
+        self.sigcomponents = sigcomponents
+
+        self.callback = None
+        self.opaque = None
+        self.frequency = 0.0
+        self.gain = 0.0
+        self.thread = None
+        self.running = False
+        self.lock = threading.Lock()
+        self.events = 0
+        self.reset()
+
+        self.blocks = [tone(program) for program in range(programs)]
+        self.logo = png(8, 8, (40, 90, 160))
+        self.art = png(8, 8, (160, 60, 40))
+        self.iqblock = bytes(32768)
+
+    def reset(self, pipe=False):
+        self.pipe = pipe
+        self.clock = 0.0
+        self.nextblock = 0.0
+        self.nextid3 = 0.0
+        self.nextsig = 0.0
+        self.nextlot = 0.0
+        self.track = 0
+
+    def emit(self, evt):
+        if self.callback is not None:
+            self.callback(ctypes.pointer(evt), self.opaque)
+            self.events += 1
+
+    def advance(self, seconds):
+        # emit everything due up to the new stream clock
+        with self.lock:
+            self.clock += seconds
+            while self.nextblock <= self.clock:
+                if self.nextsig <= self.nextblock:
+                    self.emit(sigevent(self.programs, self.sigcomponents))
+                    self.emit(sisevent(self.station, self.slogan, self.programs))
+                    self.nextsig += self.siginterval
+                if self.nextid3 <= self.nextblock:
+                    self.track += 1
+                    for program in range(self.programs):
+                        self.emit(id3event(program, "Title %d" % self.track, "Artist %d" % program,
+                                           self.track * 16 + program))
+                    self.nextid3 += self.id3interval
+                if self.nextlot <= self.nextblock:
+                    for program in range(self.programs):
+                        self.emit(lotevent(logoport(program), program, nrsc5.MIMEType.PNG, "logo.png",
+                                           self.logo))
+                        self.emit(lotevent(imageport(program), self.track * 16 + program, nrsc5.MIMEType.PNG,
+                                           "art.png", self.art))
+                    self.nextlot += self.lotinterval
+                if self.iq:
+                    self.emit(iqevent(self.iqblock))
+                for program in range(self.programs):
+                    if self.hdc:
+                        self.emit(hdcevent(program, self.blocks[program][:512]))
+                    self.emit(audioevent(program, self.blocks[program]))
+                self.nextblock += BLOCK_FRAMES / AUDIO_RATE
+
+    def worker(self):
+        self.emit(simpleevent(nrsc5.EventType.SYNC))
+        period = BLOCK_FRAMES / AUDIO_RATE
+        start = time.monotonic()
+        while self.running:
+            self.advance(period)
+            if self.speed:
+                ahead = self.clock / self.speed - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+
+    @staticmethod
+    def _set(ref, value):
+        ref._obj.value = value
+
+    def nrsc5_get_version(self, version):
+        self._set(version, b"fake")
+
+    def nrsc5_service_data_type_name(self, service_data_type, name):
+        self._set(name, nrsc5._SERVICE_DATA_TYPES[service_data_type].name.encode())
+
+    def nrsc5_program_type_name(self, program_type, name):
+        self._set(name, nrsc5._PROGRAM_TYPES[program_type].name.encode())
+
+    def nrsc5_open(self, radio, device_index):
+        self.reset()
+        return 0
+
+    def nrsc5_open_pipe(self, radio):
+        self.reset(pipe=True)
+        return 0
+
+    def nrsc5_open_rtltcp(self, radio, socket):
+        self.reset()
+        return 0
+
+    def nrsc5_close(self, radio):
+        self.nrsc5_stop(radio)
+
+    def nrsc5_start(self, radio):
+        if self.thread is None and not self.pipe:
+            self.running = True
+            self.thread = threading.Thread(target=self.worker, daemon=True)
+            self.thread.start()
+
+    def nrsc5_stop(self, radio):
+        self.running = False
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        self.thread = None
+
+    def nrsc5_set_mode(self, radio, mode):
+        return 0
+
+    def nrsc5_set_bias_tee(self, radio, on):
+        return 0
+
+    def nrsc5_set_direct_sampling(self, radio, on):
+        return 0
+
+    def nrsc5_set_freq_correction(self, radio, ppm_error):
+        return 0
+
+    def nrsc5_get_frequency(self, radio, frequency):
+        self._set(frequency, self.frequency)
+
+    def nrsc5_set_frequency(self, radio, frequency):
+        self.frequency = frequency.value
+        return 0
+
+    def nrsc5_get_gain(self, radio, gain):
+        self._set(gain, self.gain)
+
+    def nrsc5_set_gain(self, radio, gain):
+        self.gain = gain.value
+        return 0
+
+    def nrsc5_set_auto_gain(self, radio, enabled):
+        return 0
+
+    def nrsc5_set_callback(self, radio, callback, opaque):
+        self.callback = callback
+        self.opaque = opaque
+
+    def nrsc5_pipe_samples_cu8(self, radio, samples, length):
+        self.advance(length / 2 / 1488375)
+        return 0
+
+    def nrsc5_pipe_samples_cs16(self, radio, samples, length):
+        self.advance(length / 2 / 744187.5)
+        return 0
+
+
+def install(**options):
+    library = FakeLibrary(**options)
+    nrsc5.NRSC5.set_library(library)
+    return library
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import platform
+import struct
+import sys
+import time
+import wave
+import numpy
+import nrsc5
+import nrsc5audio
+import nrsc5sink
+
+MAGIC = b"NRSC5HDC\x01"
+
+# program, seconds since the start of the capture, frame length
+RECORD = struct.Struct("<BdH")
+
+# PCM frames per decoded HDC frame
+FRAME_SAMPLES = 2048
+
+
+class HDCSink(nrsc5sink.Sink):
+
+    # Captures the compressed HDC frames of any programs it is attached to, each with its arrival time.
+    # Frames are a few hundred bytes, against 8 KiB for the same audio as PCM.
+    detachable = False
+    pcm = False
+
+    def __init__(self, path, queuesize=1024):
+        super().__init__(queuesize)
+        self.path = path
+        self.file = None
+        self.origin = None
+        self.written = 0
+
+    def open(self):
+        self.file = open(self.path, "wb", buffering=1 << 20)
+        self.file.write(MAGIC)
+        self.written = len(MAGIC)
+
+    def write(self, program, data, timestamp):
+        if self.origin is None:
+            self.origin = timestamp
+        self.file.write(RECORD.pack(program, timestamp - self.origin, len(data)))
+        self.file.write(data)
+        self.written += RECORD.size + len(data)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __str__(self):
+        return "HDCSink(%s)" % self.path
+
+
+def readhdc(path, program=None):
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise nrsc5.NRSC5Error("Not an HDC capture: " + path)
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                return
+            evt_program, timestamp, length = RECORD.unpack(header)
+            data = file.read(length)
+            if program is None or evt_program == program:
+                yield evt_program, timestamp, data
+
+
+class _FrameInfo(ctypes.Structure):
+    _fields_ = [
+        ("bytesconsumed", ctypes.c_ulong),
+        ("samples", ctypes.c_ulong),
+        ("channels", ctypes.c_ubyte),
+        ("error", ctypes.c_ubyte),
+        ("samplerate", ctypes.c_ulong),
+        ("sbr", ctypes.c_ubyte),
+        ("object_type", ctypes.c_ubyte),
+        ("header_type", ctypes.c_ubyte),
+        ("num_front_channels", ctypes.c_ubyte),
+        ("num_side_channels", ctypes.c_ubyte),
+        ("num_back_channels", ctypes.c_ubyte),
+        ("num_lfe_channels", ctypes.c_ubyte),
+        ("channel_position", ctypes.c_ubyte * 64),
+        ("ps", ctypes.c_ubyte),
+    ]
+
+
+class HDCDecoder:
+
+    # Decodes HDC frames to 16-bit PCM with the faad2 that libnrsc5 is built against, which has the
+    # NeAACDecInitHDC entry point. nrsc5 usually links its patched faad2 into libnrsc5 itself, so that is tried
+    # before the system faad2, which normally lacks HDC. Set NRSC5_FAAD to use a particular library instead.
+    libfaad = None
+
+    def __init__(self):
+        self._load_library()
+        self.handle = HDCDecoder.libfaad.NeAACDecOpen()
+        samplerate = ctypes.c_ulong()
+        channels = ctypes.c_ubyte()
+        HDCDecoder.libfaad.NeAACDecInitHDC(self.handle, ctypes.byref(samplerate), ctypes.byref(channels))
+        self.info = _FrameInfo()
+        self.errors = 0
+
+    def _load_library(self):
+        if HDCDecoder.libfaad is None:
+            if os.environ.get("NRSC5_FAAD"):
+                lib_names = [os.environ["NRSC5_FAAD"]]
+            else:
+                lib_names = [nrsc5.NRSC5.library_name()]
+                if platform.system() == "Windows":
+                    lib_names.append("libfaad-2.dll")
+                else:
+                    lib_names.append(ctypes.util.find_library("faad") or "libfaad.so.2")
+            for lib_name in lib_names:
+                try:
+                    libfaad = ctypes.cdll.LoadLibrary(lib_name)
+                except OSError:
+                    continue
+                if hasattr(libfaad, "NeAACDecInitHDC"):
+                    break
+            else:
+                raise nrsc5.NRSC5Error("No faad2 with HDC support in " + ", ".join(lib_names) +
+                                       "; set NRSC5_FAAD to one")
+            libfaad.NeAACDecOpen.restype = ctypes.c_void_p
+            libfaad.NeAACDecInitHDC.argtypes = [ctypes.c_void_p, ctypes.POINTER(ctypes.c_ulong),
+                                                ctypes.POINTER(ctypes.c_ubyte)]
+            libfaad.NeAACDecDecode.restype = ctypes.POINTER(ctypes.c_int16)
+            libfaad.NeAACDecDecode.argtypes = [ctypes.c_void_p, ctypes.POINTER(_FrameInfo),
+                                               ctypes.c_char_p, ctypes.c_ulong]
+            libfaad.NeAACDecClose.argtypes = [ctypes.c_void_p]
+            HDCDecoder.libfaad = libfaad
+
+    def decode(self, data):
+        # int16 stereo frames for one HDC frame, or None if it didn't decode
+        buffer = HDCDecoder.libfaad.NeAACDecDecode(self.handle, ctypes.byref(self.info), data, len(data))
+        if self.info.error or not self.info.samples:
+            self.errors += 1
+            return None
+        samples = numpy.ctypeslib.as_array(buffer, (self.info.samples,))
+        if self.info.channels == 1:
+            return numpy.repeat(samples, 2).reshape(-1, nrsc5audio.CHANNELS)
+        return samples.reshape(-1, nrsc5audio.CHANNELS).copy()
+
+    def close(self):
+        if self.handle:
+            HDCDecoder.libfaad.NeAACDecClose(self.handle)
+            self.handle = None
+
+
+def decodehdc(path, outdir, gap=3.0):
+    # write each program of a capture to a WAV file. reception gaps longer than gap seconds are filled with
+    # silence, so the files keep the broadcast timeline
+    decoders = {}
+    files = {}
+    positions = {}
+    try:
+        for program, timestamp, data in readhdc(path):
+            if program not in decoders:
+                decoders[program] = HDCDecoder()
+                name = "%s-HD%d.wav" % (os.path.splitext(os.path.basename(path))[0], program + 1)
+                files[program] = wave.open(os.path.join(outdir, name), "wb")
+                files[program].setnchannels(nrsc5audio.CHANNELS)
+                files[program].setsampwidth(2)
+                files[program].setframerate(nrsc5audio.RATE)
+                positions[program] = int(timestamp * nrsc5audio.RATE)
+            missing = int(timestamp * nrsc5audio.RATE) - positions[program]
+            if missing > gap * nrsc5audio.RATE:
+                files[program].writeframesraw(bytes(missing * 2 * nrsc5audio.CHANNELS))
+                positions[program] += missing
+            samples = decoders[program].decode(data)
+            if samples is not None:
+                files[program].writeframesraw(samples)
+                positions[program] += len(samples)
+    finally:
+        for decoder in decoders.values():
+            decoder.close()
+        for file in files.values():
+            file.close()
+    return {program: {"frames": positions[program], "errors": decoders[program].errors} for program in decoders}
+
+
+def info(path):
+    programs = {}
+    for program, timestamp, data in readhdc(path):
+        stats = programs.setdefault(program, {"frames": 0, "bytes": 0, "start": timestamp})
+        stats["frames"] += 1
+        stats["bytes"] += len(data)
+        stats["end"] = timestamp
+    for program, stats in sorted(programs.items()):
+        seconds = stats["frames"] * FRAME_SAMPLES / nrsc5audio.RATE
+        print("HD%d: %d frames, %.1f s, %.1f kbit/s" % (
+            program + 1, stats["frames"], seconds, 8 * stats["bytes"] / seconds / 1000 if seconds else 0))
+    return programs
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or decode HDC captures")
+    commands = parser.add_subparsers(dest="command", required=True)
+    infoparser = commands.add_parser("info", help="frames and bitrate per program")
+    infoparser.add_argument("path")
+    decodeparser = commands.add_parser("decode", help="decode each program to a WAV file")
+    decodeparser.add_argument("path")
+    decodeparser.add_argument("-o", "--outdir", default=".", help="output directory")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=20, format="%(asctime)s %(message)s", datefmt="%H:%M:%S")
+    if args.command == "info":
+        info(args.path)
+    else:
+        os.makedirs(args.outdir, exist_ok=True)
+        start = time.monotonic()
+        results = decodehdc(args.path, args.outdir)
+        for program, result in sorted(results.items()):
+            logging.info("HD%d: %.1f s, %d frames failed to decode", program + 1,
+                         result["frames"] / nrsc5audio.RATE, result["errors"])
+        logging.info("Decoded in %.1f s", time.monotonic() - start)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
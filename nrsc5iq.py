@@ -0,0 +1,141 @@
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import mmap
+import os
+import queue
+import threading
+import time
+import nrsc5
+
+# complex sample rates libnrsc5 expects on its pipe input, and bytes per complex sample
+SAMPLE_RATES = {"cu8": 1488375, "cs16": 744187.5}
+SAMPLE_SIZES = {"cu8": 2, "cs16": 4}
+
+
+class IQFileReader:
+
+    def __init__(self, radio, path, iqformat="cu8", realtime=True, chunksize=131072):
+        if iqformat not in SAMPLE_RATES:
+            raise nrsc5.NRSC5Error("Unsupported IQ format: " + str(iqformat))
+        self.radio = radio
+        self.path = path
+        self.iqformat = iqformat
+        self.realtime = realtime
+        self.chunksize = chunksize - chunksize % 4
+        self.byterate = SAMPLE_RATES[iqformat] * SAMPLE_SIZES[iqformat]
+        self.size = os.path.getsize(path)
+        self.position = 0
+        self.elapsed = 0
+        self.running = False
+
+    @property
+    def duration(self):
+        return self.size / self.byterate
+
+    @property
+    def speed(self):
+        # achieved decode rate as a multiple of real time
+        if not self.elapsed:
+            return 0
+        return self.position / self.byterate / self.elapsed
+
+    def run(self):
+        if self.iqformat == "cs16":
+            pipe = self.radio.pipe_samples_cs16
+        else:
+            pipe = self.radio.pipe_samples_cu8
+
+        self.running = True
+        with open(self.path, "rb") as file, \
+                mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            size = len(data) - len(data) % 4
+            start = time.monotonic()
+            while self.running and self.position < size:
+                end = min(self.position + self.chunksize, size)
+                pipe(data[self.position:end])
+                self.position = end
+                self.elapsed = time.monotonic() - start
+                if self.realtime:
+                    ahead = self.position / self.byterate - self.elapsed
+                    if ahead > 0:
+                        time.sleep(ahead)
+            self.elapsed = time.monotonic() - start
+        self.running = False
+        return self.speed
+
+    def stop(self):
+        self.running = False
+
+
+class IQRingRecorder:
+
+    # Keeps the last seconds of IQ in a fixed size memory-mapped file, about 3 MB a second for cu8. The callback
+    # thread only queues the block it was handed; a writer thread copies it into the ring, so disk I/O never
+    # stalls the decoder. An existing file is only replaced when overwrite is set.
+    def __init__(self, path, seconds, iqformat="cu8", queuesize=256, overwrite=False):
+        size = int(seconds * SAMPLE_RATES[iqformat] * SAMPLE_SIZES[iqformat])
+        self.size = size - size % 4
+        self.path = path
+        self.queue = queue.Queue(maxsize=queuesize)
+        self.lock = threading.Lock()
+        self.position = 0
+        self.wrapped = False
+        self.written = 0
+        self.dropped = 0
+
+        try:
+            self.file = open(path, "w+b" if overwrite else "x+b")
+        except FileExistsError:
+            raise nrsc5.NRSC5Error("IQ ring file already exists: " + path)
+        if hasattr(os, "posix_fallocate"):
+            os.posix_fallocate(self.file.fileno(), 0, self.size)
+        else:
+            self.file.truncate(self.size)
+        self.ring = mmap.mmap(self.file.fileno(), self.size)
+
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def put(self, data):
+        try:
+            self.queue.put_nowait(data)
+        except queue.Full:
+            self.dropped += 1
+
+    def worker(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            with self.lock:
+                self.write(data)
+
+    def write(self, data):
+        data = memoryview(data)[-self.size:]
+        end = self.position + len(data)
+        if end <= self.size:
+            self.ring[self.position:end] = data
+        else:
+            split = self.size - self.position
+            self.ring[self.position:] = data[:split]
+            self.ring[:end - self.size] = data[split:]
+            self.wrapped = True
+        self.position = end % self.size
+        if self.position == 0:
+            self.wrapped = True
+        self.written += len(data)
+
+    def dump(self, path):
+        # write the ring out oldest first, giving a plain IQ file that IQFileReader can play back
+        with self.lock, open(path, "wb") as file:
+            if self.wrapped:
+                file.write(self.ring[self.position:])
+            file.write(self.ring[:self.position])
+        return path
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.ring.close()
+        self.file.close()
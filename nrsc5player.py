@@ -13,7 +13,7 @@ import sys
 from collections import defaultdict
 
 
-class NRSC5Player:
+class NRSC5Player(nrsc5service.ServiceListener):
 
     def __init__(self, root):
 
@@ -156,6 +156,16 @@ class NRSC5Player:
                                             command=self.settheme,
                                             variable=self.themevar)
 
+        self.normalizevar = tk.BooleanVar()
+        self.popup_menu.add_checkbutton(label="Normalize Loudness",
+                                        command=self.setnormalize,
+                                        variable=self.normalizevar)
+
+        self.limitvar = tk.BooleanVar()
+        self.popup_menu.add_checkbutton(label="Limit Peaks",
+                                        command=self.setlimit,
+                                        variable=self.limitvar)
+
         self.trafficmenuitem = self.popup_menu.add_command(
             label="Traffic Map",
             command=self.opentrafficwindow,
@@ -189,7 +199,10 @@ class NRSC5Player:
         self.root.protocol("WM_DELETE_WINDOW", self.onclose)
 
         self.service = nrsc5service.NRSC5service()
-        self.service.ui = self
+        # the service reports from libnrsc5's thread, so its updates are queued and applied here each frame
+        self.updates = nrsc5service.UIUpdateBus(self)
+        self.service.ui = self.updates
+        self.drainupdates()
 
         self.trafficimage = defaultdict(dict)
         self.trafficimageparts = defaultdict(dict)
@@ -207,6 +220,12 @@ class NRSC5Player:
         ypos = int(yscreen - ywindow)
         self.root.geometry(f"+{xpos}+{ypos}")
 
+    def drainupdates(self):
+        try:
+            self.updates.drain()
+        finally:
+            self.root.after(33, self.drainupdates)
+
     def popup(self, event):
         try:
             self.popup_menu.tk_popup(event.x_root, event.y_root, 0)
@@ -395,6 +414,8 @@ class NRSC5Player:
         self.programbtn[id].config(state="normal", text=name)
 
     def resetdisplay(self):
+        # anything still queued belongs to the previous station
+        self.updates.clear()
         for id in self.info:
             self.info[id] = None
         for id in self.infolabel:
@@ -421,6 +442,12 @@ class NRSC5Player:
         if self.service:
             self.service.setvolume(self.volumevar.get() * 0.01)
 
+    def setnormalize(self):
+        self.service.dsp.normalizer.enabled = self.normalizevar.get()
+
+    def setlimit(self):
+        self.service.dsp.limiter.enabled = self.limitvar.get()
+
     def loadconfig(self):
         self.config.read(self.configpath)
         if 'frequency' in self.config['DEFAULT']:
@@ -432,6 +459,12 @@ class NRSC5Player:
         if 'volume' in self.config['DEFAULT']:
             self.volumevar.set(self.config['DEFAULT']['volume'])
             self.setvolume(None)
+        if 'normalize' in self.config['DEFAULT']:
+            self.normalizevar.set(self.config['DEFAULT'].getboolean('normalize'))
+            self.setnormalize()
+        if 'limit' in self.config['DEFAULT']:
+            self.limitvar.set(self.config['DEFAULT'].getboolean('limit'))
+            self.setlimit()
         if 'host' in self.config['DEFAULT']:
             self.hostvar.set(self.config['DEFAULT']['host'])
         if 'cache' in self.config['DEFAULT']:
@@ -445,6 +478,8 @@ class NRSC5Player:
             'frequency': self.freqvar.get(),
             'program': self.programvar.get(),
             'volume': self.volumevar.get(),
+            'normalize': self.normalizevar.get(),
+            'limit': self.limitvar.get(),
             'host': self.hostvar.get(),
             'device': self.devicevar.get(),
             'cache': self.cachevar.get(),
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import argparse
+import asyncio
+import json
+import logging
+import struct
+import sys
+import nrsc5audio
+import nrsc5service
+import nrsc5sink
+
+# a WAV header for a stream of unknown length
+WAV_HEADER = b"RIFF" + struct.pack("<I", 0xFFFFFFFF) + b"WAVEfmt " + struct.pack(
+    "<IHHIIHH", 16, 1, nrsc5audio.CHANNELS, nrsc5audio.RATE, nrsc5audio.RATE * nrsc5audio.CHANNELS * 2,
+    nrsc5audio.CHANNELS * 2, 16) + b"data" + struct.pack("<I", 0xFFFFFFFF - 36)
+
+FORMATS = {
+    "wav": "audio/wav",
+    "pcm": "application/octet-stream",
+    "mp3": "audio/mpeg",
+}
+
+
+class ChunkRing:
+
+    # The last slots chunks of one program's stream, shared by every client of it. Chunks are numbered from
+    # zero and each client keeps its own position, so a client that falls more than slots behind is lapped.
+    # Only used on the event loop thread.
+    def __init__(self, slots=256):
+        self.slots = slots
+        self.chunks = [None] * slots
+        self.head = 0
+        self.event = asyncio.Event()
+        self.clients = 0
+
+    @property
+    def tail(self):
+        return max(0, self.head - self.slots)
+
+    def append(self, chunk):
+        self.chunks[self.head % self.slots] = chunk
+        self.head += 1
+        # wakes every waiting client
+        self.event.set()
+        self.event.clear()
+
+    def read(self, start, end):
+        return [self.chunks[position % self.slots] for position in range(start, end)]
+
+
+class StreamSink(nrsc5sink.Sink):
+
+    # Hands a program's blocks, optionally MP3 encoded, to its ring on the event loop. Encoding happens here,
+    # once per program, however many clients are listening.
+    detachable = False
+    pcm = False
+
+    def __init__(self, loop, ring, fileformat="pcm", bitrate=128, queuesize=256):
+        super().__init__(queuesize)
+        self.loop = loop
+        self.ring = ring
+        self.fileformat = fileformat
+        self.bitrate = bitrate
+        self.encoder = None
+
+    def open(self):
+        if self.fileformat == "mp3":
+            import lameenc
+            self.encoder = lameenc.Encoder()
+            self.encoder.set_bit_rate(self.bitrate)
+            self.encoder.set_in_sample_rate(nrsc5audio.RATE)
+            self.encoder.set_channels(nrsc5audio.CHANNELS)
+            self.encoder.set_quality(5)
+
+    def write(self, program, data, timestamp):
+        if self.encoder is not None:
+            data = self.encoder.encode(data)
+            if not data:
+                return
+        if not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.ring.append, data)
+
+    def __str__(self):
+        return "StreamSink(%s)" % self.fileformat
+
+
+class StreamServer:
+
+    # Serves /hd1.wav .. /hd4.wav (also .pcm, and .mp3 when lameenc is installed) from one NRSC5service.
+    # The decoder never waits on a client: a client whose socket can't keep up drops out of its ring and is
+    # disconnected.
+    def __init__(self, service, prebuffer=32, slots=256, maxbuffer=1 << 20, timeout=5.0):
+        self.service = service
+        self.prebuffer = prebuffer
+        self.slots = slots
+        self.maxbuffer = maxbuffer
+        self.timeout = timeout
+        self.rings = {}
+        self.loop = None
+        self.connections = 0
+        self.dropped = 0
+
+    def ring(self, program, fileformat):
+        # streams start on first request, so formats nobody listens to cost nothing
+        key = (program, "pcm" if fileformat == "wav" else fileformat)
+        if key not in self.rings:
+            self.rings[key] = ChunkRing(self.slots)
+            self.service.addsink(program, StreamSink(self.loop, self.rings[key], key[1]))
+        return self.rings[key]
+
+    async def handle(self, reader, writer):
+        self.connections += 1
+        try:
+            request = await reader.readuntil(b"\r\n\r\n")
+            method, path = request.split(b" ", 2)[:2]
+            path = path.decode("latin-1").split("?")[0].strip("/")
+            if method not in (b"GET", b"HEAD"):
+                await self.respond(writer, "405 Method Not Allowed", "text/plain", b"")
+            elif path == "":
+                await self.respond(writer, "200 OK", "text/html", self.index())
+            elif path == "status":
+                await self.respond(writer, "200 OK", "application/json", json.dumps(self.status()).encode())
+            else:
+                name, _, fileformat = path.partition(".")
+                if name not in ("hd1", "hd2", "hd3", "hd4") or fileformat not in FORMATS:
+                    await self.respond(writer, "404 Not Found", "text/plain", b"Not found\n")
+                elif method == b"HEAD":
+                    await self.respond(writer, "200 OK", FORMATS[fileformat], None)
+                else:
+                    await self.stream(writer, int(name[2]) - 1, fileformat)
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError, ValueError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    async def respond(self, writer, status, contenttype, body):
+        headers = "HTTP/1.1 %s\r\nContent-Type: %s\r\nCache-Control: no-cache\r\nConnection: close\r\n" % (
+            status, contenttype)
+        if body is not None:
+            headers += "Content-Length: %d\r\n" % len(body)
+        writer.write(headers.encode() + b"\r\n" + (body or b""))
+        await writer.drain()
+
+    async def stream(self, writer, program, fileformat):
+        ring = self.ring(program, fileformat)
+        await self.respond(writer, "200 OK", FORMATS[fileformat], None)
+        if fileformat == "wav":
+            writer.write(WAV_HEADER)
+        ring.clients += 1
+        try:
+            position = max(ring.tail, ring.head - self.prebuffer)
+            while True:
+                if position >= ring.head:
+                    await ring.event.wait()
+                    continue
+                if position < ring.tail or writer.transport.get_write_buffer_size() > self.maxbuffer:
+                    logging.info("Dropping slow client on HD%d", program + 1)
+                    self.dropped += 1
+                    return
+                end = ring.head
+                writer.writelines(ring.read(position, end))
+                position = end
+                try:
+                    await asyncio.wait_for(writer.drain(), self.timeout)
+                except asyncio.TimeoutError:
+                    logging.info("Dropping stalled client on HD%d", program + 1)
+                    self.dropped += 1
+                    return
+        finally:
+            ring.clients -= 1
+
+    def index(self):
+        programs = self.service.programs
+        lines = ["<html><head><title>%s</title></head><body><h1>%s</h1><ul>" % (
+            self.service.station or "NRSC5", self.service.station or "NRSC5")]
+        for program in range(4):
+            name = programs[program]["name"] if program in programs else "HD%d" % (program + 1)
+            links = " ".join('<a href="/hd%d.%s">%s</a>' % (program + 1, fileformat, fileformat)
+                             for fileformat in FORMATS)
+            lines.append("<li>%s: %s</li>" % (name, links))
+        lines.append("</ul></body></html>")
+        return "\n".join(lines).encode()
+
+    def status(self):
+        return {
+            "station": self.service.station,
+            "programs": {str(program): info.get("name") for program, info in self.service.programs.items()},
+            "connections": self.connections,
+            "dropped_clients": self.dropped,
+            "streams": [{"program": program, "format": fileformat, "clients": ring.clients, "chunks": ring.head}
+                        for (program, fileformat), ring in self.rings.items()],
+            "sinks": [{"program": program, "sink": str(sink), "blocks": sink.blocks, "dropped": sink.dropped}
+                      for program, sink in self.service.sinks.all()],
+        }
+
+    async def serve(self, host, port):
+        self.loop = asyncio.get_running_loop()
+        server = await asyncio.start_server(self.handle, host, port)
+        logging.info("Serving on %s", ", ".join("%s:%d" % socket.getsockname()[:2] for socket in server.sockets))
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Stream HD Radio programs over HTTP")
+    parser.add_argument("frequency", help="frequency in MHz")
+    parser.add_argument("-d", "--device", type=int, default=0, help="RTL-SDR device index")
+    parser.add_argument("-H", "--host", help="rtl_tcp host[:port] instead of a local device")
+    parser.add_argument("--iq-file", help="play an IQ recording instead of a device")
+    parser.add_argument("--fake", action="store_true", help="use the synthetic libnrsc5 from nrsc5fake")
+    parser.add_argument("-b", "--bind", default="0.0.0.0", help="address to listen on")
+    parser.add_argument("-p", "--port", type=int, default=8000, help="port to listen on")
+    args = parser.parse_args(argv)
+
+    if args.fake:
+        import nrsc5fake
+        nrsc5fake.install()
+
+    service = nrsc5service.NRSC5service()
+    service.playback = False
+    service.cachelogos = False
+    service.frequency = args.frequency
+    service.deviceid = args.device
+    service.host = args.host
+    service.iqfile = args.iq_file
+
+    server = StreamServer(service)
+    service.run()
+    if not service.playing:
+        return 1
+    try:
+        asyncio.run(server.serve(args.bind, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        service.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,16 +1,166 @@
 # NRSC5 Player
 # Copyright (c) 2022 Jason Yu
 
+import concurrent.futures
 import logging
 import os
-import queue
 import threading
-import pyaudio
+import time
 import numpy
 import nrsc5
+import nrsc5audio
+import nrsc5cache
+import nrsc5hdc
+import nrsc5iq
+import nrsc5sink
+import nrsc5trace
+import signal
 import sys
 from collections import defaultdict
 
+
+class ServiceListener:
+
+    # Everything NRSC5service reports to its ui. These do nothing; a front end overrides what it shows.
+    # Calls come from libnrsc5's callback thread as well as the caller's.
+    def setstatus(self, input, *args):
+        pass
+
+    def setstationname(self, name):
+        pass
+
+    def setslogan(self, slogan):
+        pass
+
+    def setprogrambutton(self, index, name):
+        pass
+
+    def setprogramname(self, name):
+        pass
+
+    def settitle(self, title):
+        pass
+
+    def setartist(self, artist):
+        pass
+
+    def setalbumartdata(self, data):
+        pass
+
+    def setalbumartfile(self, path):
+        pass
+
+    def settrafficimagepart(self, data, row, col):
+        pass
+
+
+class LoggingListener(ServiceListener):
+
+    # for running without a front end: logs what's on air. status messages are logged by the service already
+    def setstationname(self, name):
+        logging.info("Station: %s", name)
+
+    def settitle(self, title):
+        if title:
+            logging.info("Title: %s", title)
+
+    def setartist(self, artist):
+        if artist:
+            logging.info("Artist: %s", artist)
+
+
+class UIUpdateBus:
+
+    # Stands in for a listener on other threads: calls are queued, and replayed on the listener by drain(), which
+    # the front end runs on its own thread (Tk's main loop, via root.after). Repeated calls to the same method,
+    # or the same program button or traffic tile, collapse into the latest one, keeping the place of the first.
+    # Album art set from data or from a file is one update, so whichever was posted last wins.
+    def __init__(self, listener):
+        self.listener = listener
+        self.lock = threading.Lock()
+        self.pending = {}
+        self.posted = 0
+        self.applied = 0
+        self.posttime = 0.0
+
+    def __getattr__(self, name):
+        if not name.startswith("set"):
+            raise AttributeError(name)
+        return lambda *args: self.post(name, args)
+
+    def post(self, name, args):
+        start = time.perf_counter()
+        if name == "setprogrambutton":
+            key = (name, args[0])
+        elif name == "settrafficimagepart":
+            key = (name, args[1], args[2])
+        elif name in ("setalbumartdata", "setalbumartfile"):
+            key = "albumart"
+        else:
+            key = name
+        with self.lock:
+            self.pending[key] = (name, args)
+            self.posted += 1
+        self.posttime += time.perf_counter() - start
+
+    def drain(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for name, args in pending.values():
+            # one bad update, such as an image that won't open, mustn't cost the rest of the batch
+            try:
+                getattr(self.listener, name)(*args)
+            except Exception:
+                logging.exception("UI update %s failed", name)
+        self.applied += len(pending)
+        return len(pending)
+
+    def clear(self):
+        # drop queued display updates, keeping the status line
+        with self.lock:
+            self.pending = {key: update for key, update in self.pending.items() if key == "setstatus"}
+
+
+class BoundedExecutor:
+
+    # Runs slow work (file writes, logo lookups) off libnrsc5's callback thread. At most queuesize jobs may
+    # be queued or running; past that submit drops the job and counts it rather than wait. With one worker,
+    # the default, jobs run in the order submitted.
+    def __init__(self, workers=1, queuesize=32):
+        self.executor = concurrent.futures.ThreadPoolExecutor(workers, thread_name_prefix="nrsc5io")
+        self.slots = threading.BoundedSemaphore(queuesize)
+        self.submitted = 0
+        self.completed = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            self.dropped += 1
+            return None
+        self.submitted += 1
+        return self.executor.submit(self.call, fn, args)
+
+    def call(self, fn, args):
+        try:
+            return fn(*args)
+        except Exception:
+            self.failed += 1
+            logging.exception("Background job %s failed", getattr(fn, "__name__", fn))
+        finally:
+            self.completed += 1
+            self.slots.release()
+
+
+def decodeid3(value):
+    # libnrsc5 hands ID3 text over as latin-1, though stations mostly send UTF-8. text that doesn't decode as
+    # UTF-8, real latin-1 included, is passed through as it came
+    try:
+        return value.encode("latin-1").decode("utf-8")
+    except UnicodeError:
+        return value
+
+
 class NRSC5service:
 
     def __init__(self):
@@ -19,20 +169,89 @@ class NRSC5service:
                             datefmt="%H:%M:%S")
         if os.name == "nt":
             os.add_dll_directory(os.getcwd())
-        self.radio = nrsc5.NRSC5(
-            lambda evt_type, evt: self.callback(evt_type, evt))
         self.device_condition = threading.Condition()
+        # signalled when audio for the current program arrives, the program changes or playback stops
+        self.audio_condition = threading.Condition()
 
+        self.ui = ServiceListener()
         self.deviceid = 0
         self.host = None
         self.volume = 1.0
+        # gain, and optionally loudness normalization and peak limiting, applied to every block before it is played
+        self.dsp = nrsc5audio.AudioChain()
         self.frequency = 0
 
         self.bufferlength = 256
         self.bufferthresh = 32
 
+        # "blocking" writes from audio_worker; "callback" lets PortAudio pull frames through pullaudio.
+        # playback starts, and restarts after an underrun, once targetlatency seconds are buffered.
+        self.audiomode = "blocking"
+        self.framesperbuffer = 1024
+        self.targetlatency = 16 * nrsc5audio.BLOCK_FRAMES / nrsc5audio.RATE
+        # hold the buffer at targetlatency against SDR/sound card clock drift
+        self.adaptive = True
+        # keep every program buffered up to the current program's play position, so a switch continues from
+        # the same point in the broadcast, crossfaded. otherwise inactive programs are culled to bufferthresh
+        self.warmswitch = True
+
+        # event types handled by callback. anything else (IQ, HDC, MER, BER) is dropped before decoding
+        self.events = {
+            nrsc5.EventType.LOST_DEVICE,
+            nrsc5.EventType.SYNC,
+            nrsc5.EventType.LOST_SYNC,
+            nrsc5.EventType.AUDIO,
+            nrsc5.EventType.ID3,
+            nrsc5.EventType.SIG,
+            nrsc5.EventType.LOT,
+            nrsc5.EventType.SIS
+        }
+
+        # extra consumers of any program's audio (speakers, recorders, streams), alongside the player
+        self.sinks = nrsc5sink.FanOut()
+        self.recorders = {}
+        # consumers of the compressed HDC frames, see nrsc5hdc. with pcm off AUDIO events aren't taken at all,
+        # for capture-only use
+        self.hdcsinks = nrsc5sink.FanOut()
+        self.pcm = True
+        # play the current program locally. off for headless use, where sinks take the audio
+        self.playback = True
+        # libnrsc5 is loaded on first run, so traces can be replayed where it isn't installed
+        self.radio = None
+
         self.cachelogos = True
+        # byte budget for album art, logos and other LOT files held in memory
+        self.cachebudget = 16 << 20
+        # file writes and reads from the callback go here, so a slow disk can't hold up the demodulator
+        self.executor = BoundedExecutor()
+        # bumped by every updatealbumart, so a logo lookup still queued from an earlier one is ignored
+        self.albumartversion = 0
+        # callbacks taking longer than this many seconds are counted, per event type, and logged
+        self.callbackbudget = 0.005
         self.aas_dir = None
+        # where logos are cached, default aas next to the program
+        self.logodir = None
+
+        # IQ recording to play instead of a device or rtl_tcp host
+        self.iqfile = None
+        self.iqformat = "cu8"
+        self.iqrealtime = True
+        self.iqreader = None
+        self.iq_thread = None
+
+        # optional ring file holding the last iqrecordseconds of raw IQ, for dumping after reception problems.
+        # an existing file is only replaced with iqrecordoverwrite, or when this service made it on an earlier run
+        self.iqrecordfile = None
+        self.iqrecordseconds = 30
+        self.iqrecordoverwrite = False
+        self.iqrecorded = None
+        self.iqrecorder = None
+
+        # optional trace of the decoded event stream, and replay of a recorded one in place of a radio
+        self.tracefile = None
+        self.tracerecorder = None
+        self.replayer = None
+        self.replay_thread = None
 
         self.resetdata()
         self.resetprograms()
@@ -44,24 +263,52 @@ class NRSC5service:
         self.programs = {}
 
     def resetdata(self):
-        self.audio_queues = {
-            0: queue.Queue(maxsize=self.bufferlength),
-            1: queue.Queue(maxsize=self.bufferlength),
-            2: queue.Queue(maxsize=self.bufferlength),
-            3: queue.Queue(maxsize=self.bufferlength)
+        # audio path counters: frames written to the output, let go from inactive programs by design (behind the
+        # play position, or past bufferthresh), lost from inactive programs' full rings, and trimmed from the
+        # current one when it overflows, underruns, and buffer latency in seconds
+        self.stats = {
+            "written": 0,
+            "discarded": 0,
+            "dropped": 0,
+            "overruns": 0,
+            "underruns": 0,
+            "latencytotal": 0.0,
+            "latencycount": 0,
+            "latencymax": 0.0,
+            "workercpu": 0.0,
+            "driftppm": 0.0,
+            "switches": 0,
+            "switchlatencytotal": 0.0,
+            "switchlatencymax": 0.0,
+            "callbacks": 0,
+            "callbacktime": 0.0,
+            "callbackmax": 0.0,
+            "overbudget": 0
+        }
+        # event type name: [callbacks, seconds, longest, over budget]
+        self.callbackstats = defaultdict(lambda: [0, 0.0, 0.0, 0])
+        self.switchtime = None
+        self.dsp.blocks = 0
+        self.dsp.elapsed = 0
+        self.drift = nrsc5audio.DriftController(self.targetframes())
+        self.pullbuffer = numpy.empty((self.framesperbuffer * 2, nrsc5audio.CHANNELS), numpy.int16)
+        # bufferlength and bufferthresh count blocks of BLOCK_FRAMES
+        self.audio_buffers = {
+            id: nrsc5audio.AudioRingBuffer(self.bufferlength * nrsc5audio.BLOCK_FRAMES)
+            for id in range(4)
         }
         self.buffered = {}
-        self.logos = {}
+        # ("albumart", lot), ("logo", program) and ("weather",) payloads. traffic tiles go straight to the UI
+        self.cache = nrsc5cache.ByteBudgetCache(self.cachebudget)
         self.logoportmap = {}
         self.imageportmap = {}
         self.weatherport = None
-        self.weatherimage = None
         self.trafficport = None
-        self.trafficimage = defaultdict(dict)
         self.id3 = {}
-        self.albumart = {}
         self.station = None
         self.slogan = None
+        self.sigdigest = None
+        self.sisdigest = None
         self.initialbuffer = False
 
     def exceptioninfo(self, ex):
@@ -71,105 +318,102 @@ class NRSC5service:
         return message
 
     def callback(self, evt_type, evt):
+        start = time.perf_counter()
+        try:
+            self.dispatch(evt_type, evt)
+        finally:
+            elapsed = time.perf_counter() - start
+            stats = self.callbackstats[evt_type.name]
+            stats[0] += 1
+            stats[1] += elapsed
+            stats[2] = max(stats[2], elapsed)
+            self.stats["callbacks"] += 1
+            self.stats["callbacktime"] += elapsed
+            self.stats["callbackmax"] = max(self.stats["callbackmax"], elapsed)
+            if elapsed > self.callbackbudget:
+                stats[3] += 1
+                self.stats["overbudget"] += 1
+                logging.debug("%s callback took %.1f ms", evt_type.name, elapsed * 1000)
+
+    def dispatch(self, evt_type, evt):
+        if self.tracerecorder is not None:
+            self.tracerecorder.record(evt_type, evt)
 
         if evt_type == nrsc5.EventType.LOST_DEVICE:
             logging.info("Lost device")
-            #self.ui.setstatus("Lost device")
+            self.ui.setstatus("Lost device")
             with self.device_condition:
                 self.device_condition.notify()
         elif evt_type == nrsc5.EventType.SYNC:
             logging.info("Synchronized")
-            #self.ui.setstatus("Synchronized")
+            self.ui.setstatus("Synchronized")
         elif evt_type == nrsc5.EventType.LOST_SYNC:
             logging.info("Lost synchronization")
-            #self.ui.setstatus("Lost synchronization")
+            self.ui.setstatus("Lost synchronization")
+
+        elif evt_type == nrsc5.EventType.IQ:
+            if self.iqrecorder is not None:
+                self.iqrecorder.put(evt.data)
+
+        elif evt_type == nrsc5.EventType.HDC:
+            self.hdcsinks.publish(evt.program, evt.data, time.monotonic())
 
         elif evt_type == nrsc5.EventType.AUDIO:
             if self.playing:
                 try:
-                    self.audio_queues[evt.program].put(evt.data)
+                    buffer = self.audio_buffers[evt.program]
+                    current = self.audio_buffers[self.program]
+                    if self.warmswitch and buffer.end == 0 and evt.program != self.program:
+                        # a program's first audio lines up with the current program's latest audio
+                        buffer.align(current.end)
+                    timestamp = time.monotonic()
+                    self.sinks.publish(evt.program, evt.data, timestamp)
+                    overruns = buffer.overruns
+                    buffer.write(evt.data, timestamp)
+                    # frames the ring itself lost to a full buffer
+                    lost = buffer.overruns - overruns
+                    threshold = self.bufferthresh * nrsc5audio.BLOCK_FRAMES
+                    if evt.program == self.program:
+                        self.stats["overruns"] += lost
+                        if len(buffer) >= buffer.capacity:
+                            self.stats["overruns"] += buffer.trim(threshold)
+                        with self.audio_condition:
+                            self.audio_condition.notify()
+                    elif self.warmswitch:
+                        # inactive programs keep everything from the current program's play position on
+                        self.stats["dropped"] += lost
+                        self.stats["discarded"] += buffer.discard_before(current.start)
+                    else:
+                        # inactive programs are culled as they cross the threshold, in one index move
+                        self.stats["dropped"] += lost
+                        self.stats["discarded"] += buffer.trim(threshold)
                 except Exception as ex:
                     self.exceptioninfo(ex)
 
             #logging.info("Current: %d, 0: %d, 1: %d, 2: %d, 3: %d",
             #            self.program,
-            #            self.audio_queues[0].qsize(),
-            #            self.audio_queues[1].qsize(),
-            #            self.audio_queues[2].qsize(),
-            #            self.audio_queues[3].qsize())
+            #            len(self.audio_buffers[0]),
+            #            len(self.audio_buffers[1]),
+            #            len(self.audio_buffers[2]),
+            #            len(self.audio_buffers[3]))
 
         elif evt_type == nrsc5.EventType.ID3:
 
             if evt.program not in self.id3 or evt != self.id3[evt.program]:
-
-                # garbage collection?
-                if evt.program in self.id3:
-                    try:
-                        if self.id3[evt.program].xhdr is not None:
-                            currentlot = self.id3[evt.program].xhdr.lot
-                            if currentlot in self.albumart and currentlot != evt.xhdr.lot:
-                                del self.albumart[currentlot]
-                    except Exception as ex:
-                        self.exceptioninfo(ex)
-
+                # art for earlier tracks ages out of the cache
                 self.id3[evt.program] = evt
+                self.sinks.tag(evt.program, self.tags(evt.program))
 
                 if evt.program == self.program:
                     self.updateprograminfo(self.program)
                     self.updatealbumart(self.program)
 
         elif evt_type == nrsc5.EventType.SIG:
-            for service in evt:
-                #logging.info("SIG Service: type=%s number=%s name=%s",
-                #             service.type, service.number, service.name)
-                if service.type == nrsc5.ServiceType.AUDIO:
-                    index = service.number - 1
-                    if index not in self.programs:
-                        self.programs[index] = {}
-                    self.programs[index]['name'] = service.name
-                    self.ui.setprogrambutton(index, service.name)
-                    for component in service.components:
-                        #audio data
-                        if component.type == nrsc5.ComponentType.AUDIO:
-                            continue
-                            logging.info(
-                                "  Audio component: id=%s port=%04X type=%s mime=%s",
-                                component.id, component.audio.port,
-                                component.audio.type, component.audio.mime)
-                        #map ports to programs
-                        elif component.type == nrsc5.ComponentType.DATA:
-                            if component.data.mime == nrsc5.MIMEType.PRIMARY_IMAGE:
-                                self.imageportmap[component.data.port] = index
-                                self.programs[index][
-                                    'imageport'] = component.data.port
-                            if component.data.mime == nrsc5.MIMEType.STATION_LOGO:
-                                self.logoportmap[component.data.port] = index
-                                self.programs[index][
-                                    'logoport'] = component.data.port
-                            continue
-                            logging.info(
-                                "  Data component: id=%s port=%04X service_data_type=%s type=%s mime=%s",
-                                component.id, component.data.port,
-                                component.data.service_data_type,
-                                component.data.type, component.data.mime)
-
-                    if index == self.program:
-                        self.ui.setprogramname(service.name)
-                        self.updatealbumart(index)
-
-                elif service.type == nrsc5.ServiceType.DATA:
-                    for component in service.components:
-                        if component.type == nrsc5.ComponentType.DATA:
-                            if component.data.mime == nrsc5.MIMEType.TTN_STM_TRAFFIC:
-                                self.trafficport = component.data.port
-                                break
-                            elif component.data.mime == nrsc5.MIMEType.TTN_STM_WEATHER:
-                                self.weatherport = component.data.port
-                                break
-                            #logging.info("  Data component: id=%s port=%04X service_data_type=%s type=%s mime=%s",
-                            #            component.id, component.data.port,
-                            #            component.data.service_data_type,
-                            #            component.data.type, component.data.mime)
+            # stations repeat SIG periodically; only walk it when the content changed
+            digest = getattr(evt, "digest", None)
+            if digest is None or digest != self.sigdigest:
+                self.processsig(evt)
+                self.sigdigest = digest
 
         elif evt_type == nrsc5.EventType.LOT:
             #logging.info("LOT file: port=%04X lot=%s name=%s size=%s mime=%s",
@@ -179,20 +423,23 @@ class NRSC5service:
             programindex = None
             if evt.port in self.logoportmap:
                 programindex = self.logoportmap[evt.port]
-                if programindex not in self.logos:  #probably don't need to set more than once
-                    self.logos[programindex] = evt.data
+                if ("logo", programindex) not in self.cache:  #probably don't need to set more than once
+                    self.cache.put(("logo", programindex), evt.data)
                     if self.cachelogos and self.aas_dir is not None:
                         logofilename = str(self.frequency) + '-' + str(
                             programindex)
                         path = os.path.join(self.aas_dir, logofilename)
-                        with open(path, "wb") as file:
-                            file.write(evt.data)
-                            #logging.info("Writing logo %s", logofilename)
+                        self.executor.submit(self.writefile, path, evt.data)
+                        #logging.info("Writing logo %s", logofilename)
 
             elif evt.port in self.imageportmap:
                 programindex = self.imageportmap[evt.port]
-                if evt.lot not in self.albumart:  #probably don't need to set more than once
-                    self.albumart[evt.lot] = evt.data
+                if ("albumart", evt.lot) not in self.cache:  #probably don't need to set more than once
+                    self.cache.put(("albumart", evt.lot), evt.data)
+                    # the art usually arrives after the ID3 that refers to it
+                    for program, id3 in self.id3.items():
+                        if id3.xhdr is not None and id3.xhdr.lot == evt.lot:
+                            self.sinks.tag(program, self.tags(program))
 
             elif evt.port == self.trafficport:
                 if evt.name.startswith("TMT_"):
@@ -203,7 +450,7 @@ class NRSC5service:
 
             elif evt.port == self.weatherport:
                 if evt.name.startswith("DWRO_"):
-                    self.weatherimage = evt.data
+                    self.cache.put(("weather",), evt.data)
                 #elif evt.name.startswith("DWRO_") and evt.name.endswith(".txt"):
                 #    confstring = evt.data.decode()
                 #    for line in confstring.splitlines():
@@ -220,22 +467,140 @@ class NRSC5service:
                 self.updatealbumart(self.program)
 
         elif evt_type == nrsc5.EventType.SIS:
-            if evt.name and self.station != evt.name:
-                self.station = evt.name
-                self.ui.setstationname(evt.name)
-                #logging.info("Station name: %s", evt.name)
-            if evt.slogan and self.slogan != evt.slogan:
-                self.slogan = evt.slogan
-                self.ui.setslogan(evt.slogan)
-                #logging.info("Slogan: %s", evt.slogan)
+            digest = getattr(evt, "digest", None)
+            if digest is None or digest != self.sisdigest:
+                self.sisdigest = digest
+                if evt.name and self.station != evt.name:
+                    self.station = evt.name
+                    self.ui.setstationname(evt.name)
+                    #logging.info("Station name: %s", evt.name)
+                if evt.slogan and self.slogan != evt.slogan:
+                    self.slogan = evt.slogan
+                    self.ui.setslogan(evt.slogan)
+                    #logging.info("Slogan: %s", evt.slogan)
+
+    def processsig(self, sig):
+        for service in sig:
+            #logging.info("SIG Service: type=%s number=%s name=%s",
+            #             service.type, service.number, service.name)
+            if service.type == nrsc5.ServiceType.AUDIO:
+                index = service.number - 1
+                if index not in self.programs:
+                    self.programs[index] = {}
+                self.programs[index]['name'] = service.name
+                self.ui.setprogrambutton(index, service.name)
+                for component in service.components:
+                    #audio data
+                    if component.type == nrsc5.ComponentType.AUDIO:
+                        continue
+                        logging.info(
+                            "  Audio component: id=%s port=%04X type=%s mime=%s",
+                            component.id, component.audio.port,
+                            component.audio.type, component.audio.mime)
+                    #map ports to programs
+                    elif component.type == nrsc5.ComponentType.DATA:
+                        if component.data.mime == nrsc5.MIMEType.PRIMARY_IMAGE:
+                            self.imageportmap[component.data.port] = index
+                            self.programs[index][
+                                'imageport'] = component.data.port
+                        if component.data.mime == nrsc5.MIMEType.STATION_LOGO:
+                            self.logoportmap[component.data.port] = index
+                            self.programs[index][
+                                'logoport'] = component.data.port
+                        continue
+                        logging.info(
+                            "  Data component: id=%s port=%04X service_data_type=%s type=%s mime=%s",
+                            component.id, component.data.port,
+                            component.data.service_data_type,
+                            component.data.type, component.data.mime)
+
+                if index == self.program:
+                    self.ui.setprogramname(service.name)
+                    self.updatealbumart(index)
+
+            elif service.type == nrsc5.ServiceType.DATA:
+                for component in service.components:
+                    if component.type == nrsc5.ComponentType.DATA:
+                        if component.data.mime == nrsc5.MIMEType.TTN_STM_TRAFFIC:
+                            self.trafficport = component.data.port
+                            break
+                        elif component.data.mime == nrsc5.MIMEType.TTN_STM_WEATHER:
+                            self.weatherport = component.data.port
+                            break
+                        #logging.info("  Data component: id=%s port=%04X service_data_type=%s type=%s mime=%s",
+                        #            component.id, component.data.port,
+                        #            component.data.service_data_type,
+                        #            component.data.type, component.data.mime)
 
     def setprogram(self, programindex):
         if programindex != self.program and programindex in self.programs:
             logging.info("Program %s", programindex)
-            self.program = programindex
+            with self.audio_condition:
+                self.switchtime = time.monotonic()
+                if self.warmswitch:
+                    current = self.audio_buffers[self.program]
+                    self.stats["discarded"] += self.audio_buffers[programindex].discard_before(current.start)
+                    self.dsp.switch(current.peek(len(self.dsp.crossfade.tail)), self.program)
+                else:
+                    self.drift.reset()
+                self.program = programindex
+                self.audio_condition.notify()
             self.updateprograminfo(self.program)
             self.updatealbumart(self.program)
 
+    def addsink(self, program, sink):
+        return self.sinks.add(program, sink)
+
+    def removesink(self, program, sink):
+        self.sinks.remove(program, sink)
+        sink.close()
+
+    def record(self, program, directory, fileformat="wav"):
+        # record program to directory, a file per track, until stoprecording or stop
+        recorder = nrsc5sink.RecorderSink(directory, fileformat, "%s " % self.frequency)
+        self.addsink(program, recorder)
+        if program in self.id3:
+            self.sinks.tag(program, self.tags(program))
+        self.recorders[program] = recorder
+        return recorder
+
+    def stoprecording(self, program):
+        recorder = self.recorders.pop(program, None)
+        if recorder is not None:
+            self.removesink(program, recorder)
+            logging.info("Recorded %d bytes to %d files at %.1f MB/s, dropped %d blocks", recorder.written,
+                         len(recorder.paths), recorder.throughput / 1e6, recorder.dropped)
+        return recorder
+
+    def recordhdc(self, path, programs=range(4)):
+        # capture the compressed audio of programs to one file, for nrsc5hdc.py to decode later
+        sink = nrsc5hdc.HDCSink(path)
+        for program in programs:
+            self.hdcsinks.add(program, sink)
+        if self.radio is not None:
+            self.radio.set_events(self.subscriptions())
+        return sink
+
+    def subscriptions(self):
+        events = set(self.events)
+        if self.hdcsinks.sinks:
+            events.add(nrsc5.EventType.HDC)
+        if not self.pcm:
+            events.discard(nrsc5.EventType.AUDIO)
+        return events
+
+    def tags(self, program):
+        id3 = self.id3[program]
+        tags = {}
+        for key in "title", "artist", "album":
+            value = getattr(id3, key)
+            if value:
+                tags[key] = decodeid3(value)
+        art = self.cache.get(("albumart", id3.xhdr.lot)) if id3.xhdr is not None else None
+        if art is not None:
+            tags["art"] = art
+        return tags
+
     def setfrequency(self, frequency):
         if frequency != self.frequency:
             self.resetprograms()
@@ -245,56 +610,89 @@ class NRSC5service:
         if programindex in self.id3:
             title = self.id3[programindex].title
             if title:
-                title = title.encode("latin-1").decode("utf-8")
+                title = decodeid3(title)
             self.ui.settitle(title)
             artist = self.id3[programindex].artist
             if artist:
-                artist = artist.encode("latin-1").decode("utf-8")
+                artist = decodeid3(artist)
             self.ui.setartist(artist)
         if programindex in self.programs:
             programname = self.programs[programindex]['name']
             self.ui.setprogramname(programname)
 
     def updatealbumart(self, programindex):
+        # the cache lookups are cheap enough for the callback thread; only a logo on disk is read off it
+        self.albumartversion += 1
         try:
-            if self.id3[programindex].xhdr is not None:
+            lot = None
+            if programindex in self.id3 and self.id3[programindex].xhdr is not None:
                 lot = self.id3[programindex].xhdr.lot
-                if lot and lot in self.albumart:
-                    self.ui.setalbumartdata(self.albumart[lot])
-                    return
-            if programindex in self.logos:
-                self.ui.setalbumartdata(self.logos[programindex])
+            # whatever is on screen stays cached, even before it arrives
+            self.cache.repin(("albumart", lot) if lot else None, ("logo", programindex))
+            art = self.cache.get(("albumart", lot)) if lot else None
+            if art is not None:
+                self.ui.setalbumartdata(art)
+                return
+            logo = self.cache.get(("logo", programindex))
+            if logo is not None:
+                self.ui.setalbumartdata(logo)
                 return
             elif self.aas_dir is not None:
                 logofilename = str(self.frequency) + '-' + str(programindex)
                 path = os.path.join(self.aas_dir, logofilename)
-                if os.path.exists(path):
-                    self.ui.setalbumartfile(path)
-                    return
+                self.executor.submit(self.updatelogofile, programindex, path, self.albumartversion)
+                return
             self.ui.setalbumartdata(None)
             #logging.info("No current album art selected and no logo stored?")
         except Exception as ex:
             self.exceptioninfo(ex)
 
+    def updatelogofile(self, programindex, path, version):
+        # read here so the UI thread never touches the disk
+        try:
+            with open(path, "rb") as file:
+                logo = file.read()
+        except FileNotFoundError:
+            logo = None
+        # the program or its art may have changed while this waited its turn
+        if programindex == self.program and version == self.albumartversion:
+            self.ui.setalbumartdata(logo)
+
+    @staticmethod
+    def writefile(path, data):
+        with open(path, "wb") as file:
+            file.write(data)
+
+    def dumpiq(self, path):
+        # save the IQ ring in playback order, e.g. right after a dropout
+        if self.iqrecorder is None:
+            return None
+        logging.info("Dumping IQ to %s", path)
+        return self.iqrecorder.dump(path)
+
     def setvolume(self, volume):
         self.volume = volume
+        self.dsp.gain.set(volume)
 
     def run(self):
         self.resetdata()
+        self.iqreader = None
 
-        try:
-            freq = float(self.frequency)
-            if freq < 87.5 or freq > 107.9:  # TODO: AM?
-                raise ValueError
-        except ValueError:
-            self.ui.setstatus("Invalid frequency")
-            return
+        if not self.iqfile:
+            try:
+                freq = float(self.frequency)
+                if freq < 87.5 or freq > 107.9:  # TODO: AM?
+                    raise ValueError
+            except ValueError:
+                logging.info("Invalid frequency %s", self.frequency)
+                self.ui.setstatus("Invalid frequency")
+                return
 
         if hasattr(sys, 'frozen'):
             basedir = os.path.dirname(sys.executable)
         else:
             basedir = sys.path[0]
-        self.aas_dir = os.path.join(basedir, "aas")
+        self.aas_dir = self.logodir or os.path.join(basedir, "aas")
         if self.cachelogos:
             if not os.path.isdir(self.aas_dir):
                 try:
@@ -303,8 +701,33 @@ class NRSC5service:
                     self.exceptioninfo(ex)
                     self.aas_dir = None
 
+        opened = False
         try:
-            if self.host:
+            if self.radio is None:
+                self.radio = nrsc5.NRSC5(
+                    lambda evt_type, evt: self.callback(evt_type, evt),
+                    events=self.events,
+                    audio_views=True)
+            self.radio.set_events(self.subscriptions())
+
+            # the recorders can refuse their files, so they come before the radio is opened
+            if self.iqrecordfile and not self.iqfile:
+                self.iqrecorder = nrsc5iq.IQRingRecorder(
+                    self.iqrecordfile, self.iqrecordseconds,
+                    overwrite=self.iqrecordoverwrite or self.iqrecordfile == self.iqrecorded)
+                self.iqrecorded = self.iqrecordfile
+                self.radio.subscribe(nrsc5.EventType.IQ)
+
+            if self.tracefile:
+                self.tracerecorder = nrsc5trace.TraceRecorder(self.tracefile)
+
+            if self.iqfile:
+                logging.info("Reading IQ file %s", self.iqfile)
+                self.ui.setstatus("Reading IQ file %s", self.iqfile)
+                self.iqreader = nrsc5iq.IQFileReader(self.radio, self.iqfile,
+                                                     self.iqformat, self.iqrealtime)
+                self.radio.open_pipe()
+            elif self.host:
                 host = self.host
                 port = "1234"
                 if ':' in host:
@@ -316,24 +739,44 @@ class NRSC5service:
                 logging.info("Connecting to device %s", self.deviceid)
                 self.ui.setstatus("Connecting to device %s", self.deviceid)
                 self.radio.open(self.deviceid)
+            opened = True
 
-            logging.info("Tuning %s", self.frequency)
-            self.ui.setstatus("Tuning %s", self.frequency)
+            if not self.iqfile:
+                logging.info("Tuning %s", self.frequency)
+                self.ui.setstatus("Tuning %s", self.frequency)
 
-            if freq and freq < 10000:
-                freq *= 1e6
+                if freq and freq < 10000:
+                    freq *= 1e6
 
-            self.radio.set_frequency(freq)
+                self.radio.set_frequency(freq)
 
             self.playing = True
+            self.sinks.start()
+            self.hdcsinks.start()
 
-            self.audio_thread = threading.Thread(target=self.audio_worker)
-            self.audio_thread.start()
+            self.audio_thread = None
+            if self.pcm and self.playback:
+                self.audio_thread = threading.Thread(target=self.audio_worker)
+                self.audio_thread.start()
 
             self.radio.start()
 
+            if self.iqreader is not None:
+                self.iq_thread = threading.Thread(target=self.iq_worker)
+                self.iq_thread.start()
+
         except Exception as ex:
             self.ui.setstatus("Error: %s", self.exceptioninfo(ex))
+            if not self.playing:
+                # stop() only tears down a service that got as far as playing
+                if opened:
+                    self.radio.close()
+                if self.iqrecorder is not None:
+                    self.iqrecorder.close()
+                    self.iqrecorder = None
+                if self.tracerecorder is not None:
+                    self.tracerecorder.close()
+                    self.tracerecorder = None
             self.stop(True)
 
 
@@ -343,18 +786,73 @@ class NRSC5service:
         logging.info("Stopping")
 
         if self.playing == True:
-            self.playing = False
+            with self.audio_condition:
+                self.playing = False
+                self.audio_condition.notify_all()
 
-            try:
-                self.radio.stop()
-                self.radio.set_bias_tee(0)
-                self.radio.close()
-            except Exception as ex:
-                self.ui.setstatus("Error: %s", self.exceptioninfo(ex))
+            # samples are piped from iq_worker, so it has to finish before the radio closes
+            if self.iqreader is not None:
+                self.iqreader.stop()
+                if self.iq_thread is not None:
+                    self.iq_thread.join()
+                self.iq_thread = None
+
+            if self.replayer is not None:
+                self.replayer.stop()
+                if self.replay_thread is not None:
+                    self.replay_thread.join()
+                self.replayer = None
+                self.replay_thread = None
+            else:
+                try:
+                    self.radio.stop()
+                    if self.iqreader is None:
+                        self.radio.set_bias_tee(0)
+                    self.radio.close()
+                except Exception as ex:
+                    self.ui.setstatus("Error: %s", self.exceptioninfo(ex))
+
+            stats = self.stats
+            if stats["callbacks"]:
+                logging.info("Callbacks: %d, mean %.0f us, longest %.1f ms, %d over the %.0f ms budget",
+                             stats["callbacks"], 1e6 * stats["callbacktime"] / stats["callbacks"],
+                             1000 * stats["callbackmax"], stats["overbudget"], 1000 * self.callbackbudget)
+                for name, (count, elapsed, longest, over) in sorted(self.callbackstats.items()):
+                    if over:
+                        logging.info("  %s: %d of %d over budget, longest %.1f ms", name, over, count, 1000 * longest)
+            if self.executor.dropped or self.executor.failed:
+                logging.info("Background jobs: %d dropped, %d failed", self.executor.dropped, self.executor.failed)
+            cache = self.cache.stats()
+            logging.info("Image cache: %d items, %.1f of %.1f MB, %d hits, %d misses, %d evicted", cache["items"],
+                         cache["bytes"] / 1e6, cache["budget"] / 1e6, cache["hits"], cache["misses"],
+                         cache["evictions"])
+
+            if self.tracerecorder is not None:
+                self.tracerecorder.close()
+                logging.info("Traced %d events to %s, dropped %d", self.tracerecorder.count, self.tracefile,
+                             self.tracerecorder.dropped)
+                self.tracerecorder = None
 
-            for id in self.audio_queues:
-                with self.audio_queues[id].mutex:
-                    self.audio_queues[id].queue.clear()
+            if self.iqrecorder is not None:
+                self.radio.unsubscribe(nrsc5.EventType.IQ)
+                logging.info("IQ recorder wrote %d bytes, dropped %d blocks",
+                             self.iqrecorder.written, self.iqrecorder.dropped)
+                self.iqrecorder.close()
+                self.iqrecorder = None
+
+            if self.hdcsinks.sinks:
+                for sink in set(sink for program, sink in self.hdcsinks.all()):
+                    logging.info("%s: %d frames, %d bytes, dropped %d", sink, sink.blocks, sink.written, sink.dropped)
+                self.hdcsinks.close()
+
+            for program in list(self.recorders):
+                self.stoprecording(program)
+            for program, sink in self.sinks.all():
+                logging.info("%s on program %d: %d blocks, dropped %d", sink, program, sink.blocks, sink.dropped)
+            self.sinks.close()
+
+            for id in self.audio_buffers:
+                self.audio_buffers[id].clear()
 
             if self.audio_thread != None:
                 self.audio_thread.join()
@@ -364,67 +862,249 @@ class NRSC5service:
         logging.info("Disconnected")
 
 
+    def replay(self, path, speed=1.0):
+        # drive callback from a recorded trace instead of a radio. speed None replays unthrottled
+        self.resetdata()
+        self.iqreader = None
+        logging.info("Replaying %s", path)
+        self.ui.setstatus("Replaying %s", path)
+        self.replayer = nrsc5trace.TraceReplayer(path, self.callback, speed)
+
+        self.playing = True
+        self.sinks.start()
+        self.hdcsinks.start()
+
+        self.audio_thread = None
+        if self.pcm and self.playback:
+            self.audio_thread = threading.Thread(target=self.audio_worker)
+            self.audio_thread.start()
+
+        self.replay_thread = threading.Thread(target=self.replay_worker)
+        self.replay_thread.start()
+
+    def replay_worker(self):
+        try:
+            count = self.replayer.run()
+            logging.info("Replayed %d events (%.1f s) in %.1f s, %.0f events/s",
+                         count, self.replayer.duration, self.replayer.elapsed, self.replayer.rate)
+            self.ui.setstatus("Replayed %d events", count)
+        except Exception as ex:
+            self.ui.setstatus("Error: %s", self.exceptioninfo(ex))
+
+    def iq_worker(self):
+        try:
+            speed = self.iqreader.run()
+            logging.info("IQ file decoded at %.2fx real time (%.1f s in %.1f s)",
+                         speed, self.iqreader.duration, self.iqreader.elapsed)
+            self.ui.setstatus("IQ file decoded at %.2fx real time", speed)
+        except Exception as ex:
+            self.ui.setstatus("Error: %s", self.exceptioninfo(ex))
+
+    def openoutput(self):
+        if self.audiomode == "callback":
+            return nrsc5audio.PyAudioCallbackOutput(self.pullaudio, self.framesperbuffer)
+        return nrsc5audio.PyAudioOutput(self.framesperbuffer)
+
+    def targetframes(self):
+        return max(int(self.targetlatency * nrsc5audio.RATE), nrsc5audio.BLOCK_FRAMES)
+
+    def audioready(self):
+        buffer = self.audio_buffers[self.program]
+        if not self.initialbuffer:
+            self.initialbuffer = len(buffer) >= self.targetframes()
+            return self.initialbuffer
+        return len(buffer) >= nrsc5audio.BLOCK_FRAMES
+
+    def recordlatency(self, timestamp, frames):
+        self.stats["written"] += frames
+        if timestamp is not None:
+            latency = time.monotonic() - timestamp
+            self.stats["latencytotal"] += latency
+            self.stats["latencycount"] += 1
+            self.stats["latencymax"] = max(self.stats["latencymax"], latency)
+
+    def recordswitch(self, program):
+        # time from setprogram to the new program's first audio reaching the output
+        if self.switchtime is not None and program == self.program:
+            latency = time.monotonic() - self.switchtime
+            self.switchtime = None
+            self.stats["switches"] += 1
+            self.stats["switchlatencytotal"] += latency
+            self.stats["switchlatencymax"] = max(self.stats["switchlatencymax"], latency)
+
+    def pullaudio(self, out):
+        # fills out from the current program for a callback mode output; runs on the PortAudio thread
+        program = self.program
+        buffer = self.audio_buffers[program]
+        if not self.initialbuffer:
+            self.initialbuffer = len(buffer) >= self.targetframes()
+            if not self.initialbuffer:
+                out[:] = 0
+                return out
+        timestamp = buffer.timestamp()
+        fill = len(buffer)
+        # the controller only sees complete reads, so a short one can't skew the drift estimate
+        if self.adaptive and fill > len(out) * (1 + self.drift.maxppm * 1e-6) + 1:
+            self.drift.update(fill)
+            self.stats["driftppm"] = self.drift.drift
+            needed = self.drift.inputframes(len(out))
+            if len(self.pullbuffer) < needed:
+                self.pullbuffer = numpy.empty((needed, nrsc5audio.CHANNELS), numpy.int16)
+            out[:] = self.drift.stretch(buffer.read(needed, self.pullbuffer), len(out))
+            frames = len(out)
+        else:
+            frames = len(buffer.read(len(out), out))
+        if frames < len(out):
+            self.stats["underruns"] += 1
+            out[frames:] = 0
+            self.initialbuffer = False
+            self.drift.reset()
+        try:
+            self.dsp.process(out, program)
+        except Exception as ex:
+            # an exception would stop the stream; play this block unprocessed instead
+            self.exceptioninfo(ex)
+        self.recordlatency(timestamp, frames)
+        self.recordswitch(program)
+        return out
+
     def audio_worker(self):
-        audio = pyaudio.PyAudio()
         try:
-            index = audio.get_default_output_device_info()["index"]
-            stream = audio.open(format=pyaudio.paInt16,
-                                channels=2,
-                                rate=44100,
-                                #frames_per_buffer=2048, #TODO? exe uses 8192?
-                                output_device_index=index,
-                                output=True)
+            output = self.openoutput()
         except Exception as ex:
             self.exceptioninfo(ex)
-            stream = None
+            output = None
 
-        if stream:
+        cpu = time.thread_time()
+        block = numpy.empty((nrsc5audio.BLOCK_FRAMES, nrsc5audio.CHANNELS), numpy.int16)
+        if output and output.pulls:
+            # the output pulls audio itself, so just wait here until playback stops
+            with self.audio_condition:
+                while self.playing:
+                    self.audio_condition.wait()
+            output.close()
+        elif output:
             while self.playing:
+                # sleep until the current program has a block to play. the blocking write below paces the
+                # loop to the output device, and culling happens on the producer side.
+                with self.audio_condition:
+                    if self.initialbuffer and not self.audioready():
+                        self.stats["underruns"] += 1
+                        # rebuffer to the target rather than stuttering block by block
+                        self.initialbuffer = False
+                        self.drift.reset()
+                    while self.playing and not self.audioready():
+                        self.audio_condition.wait(0.5)
+                if not self.playing:
+                    break
 
-                # cull inactive/full program buffers.  can we do this without checking every loop?
-                for id in self.audio_queues.keys():
-                    if id != self.program or self.audio_queues[id].qsize() == self.bufferlength:
-                        while self.audio_queues[id].qsize() > self.bufferthresh:
-                            try:
-                                self.audio_queues[id].get(block=False)
-                            except Exception as ex:
-                                self.exceptioninfo(ex)
-                                continue
-                            else:
-                                try:
-                                    self.audio_queues[id].task_done()
-                                except Exception as ex:
-                                    self.exceptioninfo(ex)
-                                    continue
-
-                if not self.initialbuffer:
-                    self.initialbuffer = self.audio_queues[self.program].qsize() >= 16
-                #self.initialbuffer = True
-                if self.initialbuffer:
-                    try:
-                        samples = self.audio_queues[self.program].get(block=False)
-                    except queue.Empty:
-                        #self.initialbuffer = False
-                        continue
-                    except Exception as ex:
-                        self.exceptioninfo(ex)
-                        continue
-                    else:
-                        try:
-                            if self.volume < 1:
-                                decodeddata = numpy.fromstring(
-                                    samples, numpy.int16)
-                                newdata = (decodeddata * self.volume).astype(
-                                    numpy.int16)
-                                stream.write(newdata.tostring())
-                            else:
-                                stream.write(samples)
-                                self.audio_queues[self.program].task_done()
-                        except Exception as ex:
-                            self.exceptioninfo(ex)
-                            continue
-
-            stream.stop_stream()
-            stream.close()
-        audio.terminate()
+                program = self.program
+                buffer = self.audio_buffers[program]
+                timestamp = buffer.timestamp()
+                fill = len(buffer)
+                samples = buffer.read(nrsc5audio.BLOCK_FRAMES, block)
+                if self.adaptive and len(samples) == nrsc5audio.BLOCK_FRAMES:
+                    self.drift.update(fill)
+                    self.stats["driftppm"] = self.drift.drift
+                    samples = self.drift.stretch(samples, self.drift.outputframes(len(samples)))
+                try:
+                    self.dsp.process(samples, program)
+                    output.write(samples)
+                except Exception as ex:
+                    self.exceptioninfo(ex)
+                    continue
+                self.recordlatency(timestamp, len(samples))
+                self.recordswitch(program)
+
+            output.close()
+        self.stats["workercpu"] = time.thread_time() - cpu
         logging.info("Worker Stopped")
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Receive HD Radio without a user interface")
+    parser.add_argument("--freq", required=True, help="frequency in MHz")
+    parser.add_argument("--program", type=int, default=1, choices=range(1, 5), help="program to play, 1-4")
+    parser.add_argument("--device", type=int, default=0, help="RTL-SDR device index")
+    parser.add_argument("--host", help="rtl_tcp host[:port] instead of a local device")
+    parser.add_argument("--iq-file", help="play an IQ recording instead of a device")
+    parser.add_argument("--iq-format", choices=sorted(nrsc5iq.SAMPLE_RATES), default="cu8")
+    parser.add_argument("--iq-fast", action="store_true", help="decode --iq-file as fast as possible, not in real time")
+    parser.add_argument("--fake", action="store_true", help="use the synthetic libnrsc5 from nrsc5fake")
+    parser.add_argument("--no-playback", action="store_true", help="don't play audio locally")
+    parser.add_argument("--volume", type=float, default=1.0, help="playback gain, 0-1")
+    parser.add_argument("--normalize", action="store_true", help="even out loudness between programs")
+    parser.add_argument("--limit", action="store_true", help="limit peaks instead of clipping them")
+    parser.add_argument("--audio-mode", choices=["blocking", "callback"], default="blocking")
+    parser.add_argument("--latency", type=float, help="target playback latency in seconds")
+    parser.add_argument("--record", metavar="DIR", help="record programs to DIR, a file per track")
+    parser.add_argument("--record-format", choices=["wav", "flac"], default="wav")
+    parser.add_argument("--record-programs", type=int, nargs="+", default=None, choices=range(1, 5),
+                        help="programs to record, 1-4 (default: the playing program)")
+    parser.add_argument("--hdc", metavar="PATH", help="capture the HDC frames of all programs to PATH")
+    parser.add_argument("--trace", metavar="PATH", help="record an event trace to PATH")
+    parser.add_argument("--iq-record", metavar="PATH", help="keep the last --iq-record-seconds of IQ in PATH")
+    parser.add_argument("--iq-record-seconds", type=float, default=30, help="length of the IQ ring, about 3 MB/s")
+    parser.add_argument("--iq-record-overwrite", action="store_true", help="replace an existing --iq-record file")
+    parser.add_argument("--logo-dir", help="cache station logos in this directory")
+    parser.add_argument("--duration", type=float, help="stop after this many seconds")
+    args = parser.parse_args(argv)
+    if args.record and args.record_format == "flac":
+        try:
+            import soundfile
+        except ImportError:
+            parser.error("--record-format flac needs the soundfile package")
+
+    if args.fake:
+        import nrsc5fake
+        nrsc5fake.install()
+
+    service = NRSC5service()
+    service.ui = LoggingListener()
+    service.frequency = args.freq
+    service.program = args.program - 1
+    service.deviceid = args.device
+    service.host = args.host
+    service.iqfile = args.iq_file
+    service.iqformat = args.iq_format
+    service.iqrealtime = not args.iq_fast
+    service.playback = not args.no_playback
+    service.audiomode = args.audio_mode
+    if args.latency:
+        service.targetlatency = args.latency
+    service.setvolume(args.volume)
+    service.dsp.normalizer.enabled = args.normalize
+    service.dsp.limiter.enabled = args.limit
+    service.tracefile = args.trace
+    service.iqrecordfile = args.iq_record
+    service.iqrecordseconds = args.iq_record_seconds
+    service.iqrecordoverwrite = args.iq_record_overwrite
+    service.cachelogos = args.logo_dir is not None
+    service.logodir = args.logo_dir
+    if args.hdc:
+        service.recordhdc(args.hdc)
+
+    stopping = threading.Event()
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+    # recorders start with the service, so a fast IQ file is recorded from its first block
+    if args.record:
+        for program in args.record_programs or [args.program]:
+            service.record(program - 1, args.record, args.record_format)
+    service.run()
+    if not service.playing:
+        return 1
+    if service.iq_thread is not None:
+        # an IQ file runs out by itself
+        reader = service.iq_thread
+        threading.Thread(target=lambda: (reader.join(), stopping.set()), daemon=True).start()
+    try:
+        stopping.wait(args.duration)
+    except KeyboardInterrupt:
+        pass
+    service.stop()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
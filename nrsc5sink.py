@@ -0,0 +1,404 @@
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import collections
+import logging
+import os
+import re
+import shutil
+import struct
+import threading
+import time
+import wave
+import numpy
+import nrsc5audio
+
+
+class SinkQueue:
+
+    # A sink's work items in order. Audio is refused once maxsize items are waiting, but tags and the stop
+    # marker are always taken, so a sink that falls behind loses audio and never a track change.
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.items = collections.deque()
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item, force=False):
+        with self.condition:
+            if not force and len(self.items) >= self.maxsize:
+                return False
+            self.items.append(item)
+            self.condition.notify()
+            return True
+
+    def get(self):
+        with self.condition:
+            while not self.items:
+                self.condition.wait()
+            return self.items.popleft()
+
+
+class Sink:
+
+    # Consumes one program's audio on its own thread. put() never blocks the decoder: when the queue is full
+    # the sink has fallen behind, and the fan-out detaches it, or for a sink that isn't detachable drops the
+    # block. Subclasses implement open, write, settags and finish. write gets int16 frames, or the bytes as
+    # published for a sink that isn't pcm. One sink may be attached to several programs.
+    detachable = True
+    pcm = True
+
+    def __init__(self, queuesize=64):
+        self.queue = SinkQueue(queuesize)
+        self.running = False
+        self.thread = None
+        self.blocks = 0
+        self.frames = 0
+        self.dropped = 0
+
+    def start(self):
+        if self.thread is not None:
+            return
+        self.running = True
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def put(self, item):
+        if self.queue.put(item):
+            return True
+        self.dropped += 1
+        return False
+
+    def tag(self, program, tags):
+        self.queue.put((program, None, tags), force=True)
+
+    def worker(self):
+        try:
+            self.open()
+            while self.running:
+                item = self.queue.get()
+                if item is None:
+                    break
+                program, data, timestamp = item
+                if data is None:
+                    # timestamp carries the tags for a tag item
+                    self.settags(program, timestamp)
+                    continue
+                if self.pcm:
+                    data = numpy.frombuffer(data, numpy.int16).reshape(-1, nrsc5audio.CHANNELS)
+                    self.frames += len(data)
+                self.write(program, data, timestamp)
+                self.blocks += 1
+        except Exception:
+            logging.exception("Sink %s failed", self)
+        finally:
+            self.running = False
+            self.finish()
+
+    def detach(self):
+        # stop without waiting for queued audio, for a sink that fell behind
+        self.running = False
+        self.queue.put(None, force=True)
+
+    def close(self):
+        # write out everything queued, then stop
+        if self.thread is None:
+            return
+        if self.running:
+            self.queue.put(None, force=True)
+        self.thread.join()
+        self.thread = None
+
+    def open(self):
+        pass
+
+    def write(self, program, samples, timestamp):
+        pass
+
+    def settags(self, program, tags):
+        pass
+
+    def finish(self):
+        pass
+
+    def __str__(self):
+        return type(self).__name__
+
+
+class NullSink(Sink):
+    pass
+
+
+class OutputSink(Sink):
+
+    # Plays a program on an output with a blocking write(samples), such as nrsc5audio.PyAudioOutput
+    def __init__(self, output=None, queuesize=64):
+        super().__init__(queuesize)
+        self.output = output
+
+    def open(self):
+        if self.output is None:
+            self.output = nrsc5audio.PyAudioOutput()
+
+    def write(self, program, samples, timestamp):
+        self.output.write(samples)
+
+    def finish(self):
+        self.output.close()
+
+
+class WaveSink(Sink):
+
+    def __init__(self, path, queuesize=64):
+        super().__init__(queuesize)
+        self.path = path
+        self.file = None
+
+    def open(self):
+        self.file = wave.open(self.path, "wb")
+        self.file.setnchannels(nrsc5audio.CHANNELS)
+        self.file.setsampwidth(2)
+        self.file.setframerate(nrsc5audio.RATE)
+
+    def write(self, program, samples, timestamp):
+        self.file.writeframesraw(samples)
+
+    def finish(self):
+        if self.file is not None:
+            self.file.close()
+
+    def __str__(self):
+        return "WaveSink(%s)" % self.path
+
+
+def id3tag(tags):
+    # ID3v2.3 tag with title, artist, album and cover art, for a WAV "id3 " chunk
+    frames = b""
+    for frame, key in (b"TIT2", "title"), (b"TPE1", "artist"), (b"TALB", "album"):
+        if tags.get(key):
+            data = b"\x01" + tags[key].encode("utf-16")
+            frames += frame + struct.pack(">IH", len(data), 0) + data
+    art = tags.get("art")
+    if art:
+        data = b"\x00" + imagemime(art).encode() + b"\x00\x03\x00" + art
+        frames += b"APIC" + struct.pack(">IH", len(data), 0) + data
+    size = len(frames)
+    synchsafe = bytes((size >> shift) & 0x7f for shift in (21, 14, 7, 0))
+    return b"ID3\x03\x00\x00" + synchsafe + frames
+
+
+def imagemime(data):
+    if data.startswith(b"\x89PNG"):
+        return "image/png"
+    return "image/jpeg"
+
+
+def flacpicture(path, art):
+    # add art as a front cover METADATA_BLOCK_PICTURE after a FLAC file's other metadata, rewriting the file
+    mime = imagemime(art).encode()
+    block = struct.pack(">II", 3, len(mime)) + mime + struct.pack(">6I", 0, 0, 0, 0, 0, len(art)) + art
+    if len(block) >= 1 << 24:
+        return False
+    temporary = path + ".part"
+    with open(path, "rb") as source, open(temporary, "wb") as target:
+        if source.read(4) != b"fLaC":
+            raise ValueError("Not a FLAC file: " + path)
+        target.write(b"fLaC")
+        last = False
+        while not last:
+            header = source.read(4)
+            if len(header) < 4:
+                raise ValueError("Truncated FLAC metadata: " + path)
+            last = header[0] & 0x80
+            target.write(bytes((header[0] & 0x7f,)) + header[1:])
+            target.write(source.read(int.from_bytes(header[1:], "big")))
+        target.write(bytes((0x80 | 6,)) + len(block).to_bytes(3, "big") + block)
+        shutil.copyfileobj(source, target, 1 << 20)
+    os.replace(temporary, path)
+    return True
+
+
+class RecorderSink(Sink):
+
+    # Records a program to WAV, or FLAC when soundfile is installed, starting a new file whenever the title
+    # or artist changes. Audio is gathered into chunksize byte chunks so the disk sees large sequential
+    # writes. WAV files get an ID3 chunk with the cover art; FLAC files get it as a picture block.
+    detachable = False
+
+    def __init__(self, directory, fileformat="wav", prefix="", chunksize=1 << 20, queuesize=256):
+        super().__init__(queuesize)
+        if fileformat not in ("wav", "flac"):
+            raise ValueError("Unsupported recording format: " + str(fileformat))
+        if fileformat == "flac":
+            # fail here, in the caller's thread, rather than on the first block in the worker
+            import soundfile
+        self.directory = directory
+        self.fileformat = fileformat
+        self.prefix = prefix
+        self.chunk = bytearray(chunksize - chunksize % 4)
+        self.fill = 0
+        self.file = None
+        self.path = None
+        self.tags = {}
+        self.paths = []
+        self.written = 0
+        self.writetime = 0.0
+
+    @property
+    def throughput(self):
+        # bytes per second of time spent writing
+        return self.written / self.writetime if self.writetime else 0
+
+    def open(self):
+        os.makedirs(self.directory, exist_ok=True)
+
+    def write(self, program, samples, timestamp):
+        if self.file is None:
+            self.openfile(program)
+        data = memoryview(samples).cast("B")
+        while len(data):
+            count = min(len(data), len(self.chunk) - self.fill)
+            self.chunk[self.fill:self.fill + count] = data[:count]
+            self.fill += count
+            data = data[count:]
+            if self.fill == len(self.chunk):
+                self.flush()
+
+    def settags(self, program, tags):
+        # a file started before any tags arrived just takes the first ones
+        current = (self.tags.get("title"), self.tags.get("artist"))
+        if self.file is not None and any(current) and (tags.get("title"), tags.get("artist")) != current:
+            self.closefile()
+        self.tags = dict(tags)
+        if self.file is None:
+            self.openfile(program)
+
+    def filename(self, program):
+        name = "%s%s HD%d" % (self.prefix, time.strftime("%Y%m%d-%H%M%S"), program + 1)
+        if self.tags.get("artist") or self.tags.get("title"):
+            name += " %s - %s" % (self.tags.get("artist") or "", self.tags.get("title") or "")
+        name = re.sub(r'[\\/:*?"<>|\x00-\x1f]', "_", name).strip()
+        path = os.path.join(self.directory, name + "." + self.fileformat)
+        count = 1
+        while os.path.exists(path):
+            count += 1
+            path = os.path.join(self.directory, "%s (%d).%s" % (name, count, self.fileformat))
+        return path
+
+    def openfile(self, program):
+        self.path = self.filename(program)
+        if self.fileformat == "flac":
+            import soundfile
+            self.file = soundfile.SoundFile(self.path, "w", nrsc5audio.RATE, nrsc5audio.CHANNELS,
+                                            "PCM_16", format="FLAC")
+            for key in "title", "artist", "album":
+                if self.tags.get(key):
+                    setattr(self.file, key, self.tags[key])
+        else:
+            self.file = wave.open(self.path, "wb")
+            self.file.setnchannels(nrsc5audio.CHANNELS)
+            self.file.setsampwidth(2)
+            self.file.setframerate(nrsc5audio.RATE)
+        self.paths.append(self.path)
+        logging.info("Recording to %s", self.path)
+
+    def flush(self):
+        if not self.fill:
+            return
+        start = time.perf_counter()
+        data = memoryview(self.chunk)[:self.fill]
+        if self.fileformat == "flac":
+            self.file.buffer_write(data, "int16")
+        else:
+            self.file.writeframesraw(data)
+        self.writetime += time.perf_counter() - start
+        self.written += self.fill
+        self.fill = 0
+
+    def closefile(self):
+        self.flush()
+        self.file.close()
+        art = self.tags.get("art")
+        if self.fileformat == "wav":
+            # RIFF chunks are word aligned and the RIFF size covers everything after it
+            tag = id3tag(self.tags)
+            with open(self.path, "r+b") as file:
+                file.seek(0, os.SEEK_END)
+                file.write(b"id3 " + struct.pack("<I", len(tag)) + tag + b"\x00" * (len(tag) % 2))
+                size = file.tell() - 8
+                file.seek(4)
+                file.write(struct.pack("<I", size))
+        elif art:
+            flacpicture(self.path, art)
+        self.file = None
+
+    def finish(self):
+        if self.file is not None:
+            self.closefile()
+
+    def __str__(self):
+        return "RecorderSink(%s)" % self.directory
+
+
+class FanOut:
+
+    # Delivers each program's audio to any number of sinks. The decoded block is copied once and that
+    # immutable copy is shared by every sink of the program. The sink lists are replaced rather than
+    # modified, so publish() iterates them without taking the lock. Sinks added before start() wait for it
+    # to start their threads.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.sinks = {}
+        self.started = False
+        self.detached = 0
+
+    def start(self):
+        with self.lock:
+            self.started = True
+            for program, sink in self.all():
+                sink.start()
+
+    def add(self, program, sink):
+        with self.lock:
+            self.sinks[program] = self.sinks.get(program, ()) + (sink,)
+            if self.started:
+                sink.start()
+        return sink
+
+    def remove(self, program, sink):
+        with self.lock:
+            sinks = tuple(s for s in self.sinks.get(program, ()) if s is not sink)
+            if sinks:
+                self.sinks[program] = sinks
+            else:
+                self.sinks.pop(program, None)
+        return sink
+
+    def publish(self, program, data, timestamp=None):
+        sinks = self.sinks.get(program)
+        if not sinks:
+            return
+        item = (program, bytes(data), timestamp)
+        for sink in sinks:
+            if not sink.put(item) and sink.detachable:
+                logging.info("%s fell behind on program %d, detaching", sink, program)
+                self.remove(program, sink)
+                sink.detach()
+                self.detached += 1
+
+    def tag(self, program, tags):
+        # pass track metadata to the program's sinks, in order with its audio
+        for sink in self.sinks.get(program, ()):
+            sink.tag(program, tags)
+
+    def all(self):
+        return [(program, sink) for program, sinks in self.sinks.items() for sink in sinks]
+
+    def close(self):
+        with self.lock:
+            self.started = False
+        for program, sink in self.all():
+            self.remove(program, sink)
+            sink.close()
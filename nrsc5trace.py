@@ -0,0 +1,204 @@
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import enum
+import json
+import logging
+import queue
+import struct
+import threading
+import time
+import nrsc5
+
+MAGIC = b"NRSC5TRACE\x02"
+
+# event type, seconds since the start of the trace, payload length
+RECORD = struct.Struct("<BdI")
+PROGRAM = struct.Struct("<B")
+# length of the JSON that starts every other payload. the bytes fields follow it, in the order they appear
+FIELDS = struct.Struct("<I")
+
+EVENTS = {
+    nrsc5.EventType.LOST_DEVICE,
+    nrsc5.EventType.SYNC,
+    nrsc5.EventType.LOST_SYNC,
+    nrsc5.EventType.AUDIO,
+    nrsc5.EventType.ID3,
+    nrsc5.EventType.SIG,
+    nrsc5.EventType.LOT,
+    nrsc5.EventType.SIS
+}
+
+# the only types a trace can name, so reading one never builds anything else
+TYPES = {cls.__name__: cls for cls in (
+    nrsc5.IQ, nrsc5.MER, nrsc5.BER, nrsc5.HDC, nrsc5.Audio, nrsc5.UFID, nrsc5.XHDR, nrsc5.ID3,
+    nrsc5.SIGAudioComponent, nrsc5.SIGDataComponent, nrsc5.SIGComponent, nrsc5.SIGService, nrsc5.SIG,
+    nrsc5.LOT, nrsc5.SISAudioService, nrsc5.SISDataService, nrsc5.SIS)}
+ENUMS = {cls.__name__: cls for cls in (
+    nrsc5.ServiceType, nrsc5.ComponentType, nrsc5.MIMEType, nrsc5.Access, nrsc5.ServiceDataType,
+    nrsc5.ProgramType)}
+
+
+def encodefields(value, blobs):
+    if isinstance(value, nrsc5.Unknown):
+        return {"unknown": value.enum.__name__, "value": value.value}
+    if isinstance(value, enum.Enum):
+        return {"enum": type(value).__name__, "name": value.name}
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        blobs.append(bytes(value))
+        return {"bytes": len(value)}
+    if isinstance(value, tuple) and type(value).__name__ in TYPES:
+        return {"type": type(value).__name__, "fields": [encodefields(item, blobs) for item in value]}
+    if isinstance(value, (list, tuple)):
+        return [encodefields(item, blobs) for item in value]
+    return value
+
+
+def decodefields(value, blobs):
+    if isinstance(value, list):
+        return [decodefields(item, blobs) for item in value]
+    if not isinstance(value, dict):
+        return value
+    if "type" in value:
+        return TYPES[value["type"]](*(decodefields(item, blobs) for item in value["fields"]))
+    if "enum" in value:
+        return ENUMS[value["enum"]][value["name"]]
+    if "unknown" in value:
+        return nrsc5.Unknown(ENUMS[value["unknown"]], value["value"])
+    if "bytes" in value:
+        data = blobs[0][:value["bytes"]]
+        blobs[0] = blobs[0][value["bytes"]:]
+        return bytes(data)
+    raise ValueError("Unexpected trace field")
+
+
+def encodeevent(evt):
+    blobs = []
+    fields = json.dumps(encodefields(evt, blobs), separators=(",", ":")).encode()
+    return [FIELDS.pack(len(fields)), fields] + blobs
+
+
+def decodeevent(payload):
+    length, = FIELDS.unpack_from(payload)
+    fields = json.loads(bytes(payload[FIELDS.size:FIELDS.size + length]))
+    return decodefields(fields, [memoryview(payload)[FIELDS.size + length:]])
+
+
+class TraceRecorder:
+
+    # The callback thread only queues events; a writer thread encodes them and writes the file, so disk I/O
+    # never stalls the decoder. Events arriving while the queue is full are dropped and counted.
+    def __init__(self, path, events=EVENTS, queuesize=4096):
+        self.path = path
+        self.events = events
+        self.queue = queue.Queue(maxsize=queuesize)
+        self.file = open(path, "wb", buffering=1 << 20)
+        self.file.write(MAGIC)
+        self.start = time.monotonic()
+        self.count = 0
+        self.dropped = 0
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+
+    def record(self, evt_type, evt):
+        if evt_type not in self.events:
+            return
+        # lazy SIG/SIS views and audio views only live for the duration of the callback
+        if hasattr(evt, "materialize"):
+            evt = evt.materialize()
+        elif evt_type == nrsc5.EventType.AUDIO:
+            evt = nrsc5.Audio(evt.program, bytes(evt.data))
+        try:
+            self.queue.put_nowait((evt_type, time.monotonic() - self.start, evt))
+        except queue.Full:
+            self.dropped += 1
+
+    def worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            evt_type, timestamp, evt = item
+            if evt_type == nrsc5.EventType.AUDIO:
+                payload = (PROGRAM.pack(evt.program), evt.data)
+            elif evt is None:
+                payload = ()
+            else:
+                payload = encodeevent(evt)
+            self.file.write(RECORD.pack(evt_type.value, timestamp, sum(len(part) for part in payload)))
+            for part in payload:
+                self.file.write(part)
+            self.count += 1
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+def readtrace(path):
+    with open(path, "rb") as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise nrsc5.NRSC5Error("Not an event trace: " + path)
+        while True:
+            header = file.read(RECORD.size)
+            if len(header) < RECORD.size:
+                if header:
+                    logging.info("Trace %s ends in a truncated record", path)
+                return
+            value, timestamp, length = RECORD.unpack(header)
+            payload = file.read(length)
+            if len(payload) < length:
+                # the recorder was killed mid-write
+                logging.info("Trace %s ends in a truncated record", path)
+                return
+            evt_type = nrsc5.EventType(value)
+            try:
+                if evt_type == nrsc5.EventType.AUDIO:
+                    evt = nrsc5.Audio(payload[0], payload[PROGRAM.size:])
+                elif length:
+                    evt = decodeevent(payload)
+                else:
+                    evt = None
+            except (KeyError, IndexError, TypeError, ValueError, struct.error) as ex:
+                raise nrsc5.NRSC5Error("Corrupt event trace %s: %s" % (path, ex))
+            yield timestamp, evt_type, evt
+
+
+class TraceReplayer:
+
+    # Feeds a recorded trace to a callback, at the recorded pace scaled by speed, or as fast as possible when
+    # speed is None.
+    def __init__(self, path, callback, speed=1.0):
+        self.path = path
+        self.callback = callback
+        self.speed = speed
+        self.running = False
+        self.count = 0
+        self.duration = 0
+        self.elapsed = 0
+
+    def run(self):
+        self.running = True
+        start = time.monotonic()
+        for timestamp, evt_type, evt in readtrace(self.path):
+            if not self.running:
+                break
+            if self.speed:
+                ahead = timestamp / self.speed - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+            self.callback(evt_type, evt)
+            self.count += 1
+            self.duration = timestamp
+        self.elapsed = time.monotonic() - start
+        self.running = False
+        return self.count
+
+    @property
+    def rate(self):
+        # events per second actually delivered
+        return self.count / self.elapsed if self.elapsed else 0
+
+    def stop(self):
+        self.running = False
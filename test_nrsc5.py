@@ -0,0 +1,343 @@
+# NRSC5 Player
+# Copyright (c) 2022 Jason Yu
+
+import os
+import struct
+import sys
+import time
+import wave
+import numpy
+import pytest
+import nrsc5
+import nrsc5audio
+import nrsc5cache
+import nrsc5fake
+import nrsc5service
+import nrsc5sink
+import nrsc5trace
+
+
+@pytest.fixture
+def fake():
+    library = nrsc5fake.install(speed=8)
+    yield library
+    nrsc5.NRSC5.set_library(None)
+
+
+def piperadio(callback, **options):
+    # a radio whose events come from fake.emit
+    radio = nrsc5.NRSC5(callback, **options)
+    radio.open_pipe()
+    return radio
+
+
+def frames(start, count):
+    # stereo frames numbered from start, so reads show which ones came back
+    values = numpy.arange(start, start + count, dtype=numpy.int16)
+    return numpy.repeat(values, nrsc5audio.CHANNELS).reshape(-1, nrsc5audio.CHANNELS)
+
+
+def test_ringbuffer_wraps():
+    buffer = nrsc5audio.AudioRingBuffer(8)
+    buffer.write(frames(0, 6))
+    assert buffer.read(4)[:, 0].tolist() == [0, 1, 2, 3]
+    buffer.write(frames(6, 5))
+    assert len(buffer) == 7
+    assert buffer.peek(7)[:, 0].tolist() == [4, 5, 6, 7, 8, 9, 10]
+    assert buffer.read(10)[:, 0].tolist() == [4, 5, 6, 7, 8, 9, 10]
+    assert len(buffer) == 0
+    assert buffer.overruns == 0
+
+
+def test_ringbuffer_overrun_keeps_newest():
+    buffer = nrsc5audio.AudioRingBuffer(8)
+    buffer.write(frames(0, 6))
+    buffer.write(frames(6, 6))
+    assert buffer.overruns == 4
+    assert buffer.start == 4 and buffer.end == 12
+    assert buffer.read(8)[:, 0].tolist() == list(range(4, 12))
+    buffer.write(frames(12, 20))
+    assert buffer.read(8)[:, 0].tolist() == list(range(24, 32))
+
+
+def test_ringbuffer_discard_and_align():
+    buffer = nrsc5audio.AudioRingBuffer(16)
+    buffer.align(100)
+    buffer.write(frames(0, 8))
+    assert buffer.discard_before(104) == 4
+    assert buffer.start == 104
+    assert buffer.trim(2) == 2
+    assert buffer.read(8)[:, 0].tolist() == [6, 7]
+
+
+def test_cache_evicts_least_recently_used():
+    cache = nrsc5cache.ByteBudgetCache(100)
+    cache.put("a", bytes(40))
+    cache.put("b", bytes(40))
+    cache.get("a")
+    cache.put("c", bytes(40))
+    assert "a" in cache and "c" in cache and "b" not in cache
+    assert cache.size == 80
+    assert cache.stats()["evictions"] == 1
+
+
+def test_cache_keeps_pinned_over_budget():
+    cache = nrsc5cache.ByteBudgetCache(100)
+    cache.repin("logo", None)
+    assert cache.pinned == {"logo"}
+    cache.put("logo", bytes(80))
+    cache.put("art", bytes(80))
+    assert "logo" in cache and "art" not in cache
+    cache.repin("art")
+    cache.put("art", bytes(80))
+    assert "art" in cache and "logo" not in cache
+
+
+class Recorder:
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        return lambda *args: self.calls.append((name,) + args)
+
+
+def test_updatebus_coalesces():
+    listener = Recorder()
+    bus = nrsc5service.UIUpdateBus(listener)
+    bus.settitle("one")
+    bus.setprogrambutton(0, "HD1")
+    bus.setprogrambutton(1, "HD2")
+    bus.settitle("two")
+    bus.setalbumartdata(b"art")
+    bus.setalbumartfile("logo.png")
+    bus.setalbumartdata(b"newer")
+    assert bus.drain() == 4
+    assert listener.calls == [("settitle", "two"), ("setprogrambutton", 0, "HD1"),
+                              ("setprogrambutton", 1, "HD2"), ("setalbumartdata", b"newer")]
+    assert bus.drain() == 0
+
+
+def test_updatebus_survives_failing_update():
+    listener = Recorder()
+
+    def setalbumartdata(data):
+        raise OSError("cannot identify image file")
+
+    listener.setalbumartdata = setalbumartdata
+    bus = nrsc5service.UIUpdateBus(listener)
+    bus.setalbumartdata(b"corrupt")
+    bus.setstatus("Playing")
+    assert bus.drain() == 2
+    assert listener.calls == [("setstatus", "Playing")]
+
+
+def test_trace_round_trip(tmp_path, fake):
+    path = str(tmp_path / "events.trace")
+    recorder = nrsc5trace.TraceRecorder(path)
+    expected = []
+
+    def callback(evt_type, evt):
+        if hasattr(evt, "materialize"):
+            expected.append((evt_type, evt.materialize()))
+        elif evt_type == nrsc5.EventType.AUDIO:
+            expected.append((evt_type, nrsc5.Audio(evt.program, bytes(evt.data))))
+        else:
+            expected.append((evt_type, evt))
+        recorder.record(evt_type, evt)
+
+    radio = nrsc5.NRSC5(callback, audio_views=True)
+    radio.open_pipe()
+    radio.pipe_samples_cu8(bytes(4 * 1488375))
+    radio.close()
+    recorder.close()
+
+    replayed = []
+    replayer = nrsc5trace.TraceReplayer(path, lambda evt_type, evt: replayed.append((evt_type, evt)), None)
+    assert replayer.run() == len(expected) == recorder.count
+    assert replayed == expected
+    assert {evt_type for evt_type, evt in replayed} >= {
+        nrsc5.EventType.AUDIO, nrsc5.EventType.ID3, nrsc5.EventType.SIG, nrsc5.EventType.SIS, nrsc5.EventType.LOT}
+
+    # a trace cut off mid-record replays up to the last whole one
+    with open(path, "r+b") as file:
+        file.truncate(os.path.getsize(path) - 3)
+    assert len(list(nrsc5trace.readtrace(path))) == len(expected) - 1
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnraisableExceptionWarning")
+def test_lazy_views_released_when_callback_raises(fake):
+    kept = []
+
+    def callback(evt_type, evt):
+        kept.append(evt)
+        raise RuntimeError("callback failed")
+
+    piperadio(callback)
+    fake.emit(nrsc5fake.sigevent(4))
+    fake.emit(nrsc5fake.sisevent("FAKE", "Slogan"))
+    assert len(kept) == 2
+    for evt in kept:
+        with pytest.raises(nrsc5.NRSC5Error):
+            evt.materialize()
+
+
+def test_lazy_view_digests(fake):
+    digests = []
+    piperadio(lambda evt_type, evt: digests.append((evt_type, evt.digest)))
+    fake.emit(nrsc5fake.sigevent(4))
+    fake.emit(nrsc5fake.sigevent(4))
+    fake.emit(nrsc5fake.sigevent(3))
+    fake.emit(nrsc5fake.sisevent("FAKE", "Slogan"))
+    fake.emit(nrsc5fake.sisevent("FAKE", "Slogan"))
+    fake.emit(nrsc5fake.sisevent("FAKE", "Other slogan"))
+    sig = [digest for evt_type, digest in digests if evt_type == nrsc5.EventType.SIG]
+    sis = [digest for evt_type, digest in digests if evt_type == nrsc5.EventType.SIS]
+    assert sig[0] == sig[1] != sig[2]
+    assert sis[0] == sis[1] != sis[2]
+
+
+def test_unknown_enum_values(fake):
+    events = []
+    piperadio(lambda evt_type, evt: events.append(evt.materialize() if hasattr(evt, "materialize") else evt))
+    lot = nrsc5fake.lotevent(0x1000, 1, nrsc5.MIMEType.PNG, "art.png", b"data")
+    lot.u.lot.mime = 0x12345678
+    fake.emit(lot)
+    sig = nrsc5fake.sigevent(1, components=1)
+    sig.u.sig.services.contents.components.contents.next.contents.u.data.service_data_type = 999
+    fake.emit(sig)
+    assert events[0].mime == nrsc5.Unknown(nrsc5.MIMEType, 0x12345678)
+    assert events[0].mime.name == "UNKNOWN"
+    data = events[1][0].components[1].data
+    assert data.service_data_type == nrsc5.Unknown(nrsc5.ServiceDataType, 999)
+    assert data.mime == nrsc5.MIMEType.STATION_LOGO
+
+
+def test_event_mask(fake):
+    received = []
+    radio = piperadio(lambda evt_type, evt: received.append(evt_type), events={nrsc5.EventType.ID3})
+    fake.emit(nrsc5fake.audioevent(0, nrsc5fake.tone(0)))
+    fake.emit(nrsc5fake.id3event(0, "Title", "Artist"))
+    radio.subscribe(nrsc5.EventType.AUDIO)
+    fake.emit(nrsc5fake.audioevent(0, nrsc5fake.tone(0)))
+    radio.unsubscribe(nrsc5.EventType.ID3)
+    fake.emit(nrsc5fake.id3event(0, "Title", "Artist"))
+    assert received == [nrsc5.EventType.ID3, nrsc5.EventType.AUDIO]
+    assert radio.events == {nrsc5.EventType.AUDIO}
+    radio.set_events(None)
+    fake.emit(nrsc5fake.simpleevent(nrsc5.EventType.SYNC))
+    assert received[-1] == nrsc5.EventType.SYNC
+
+
+def riffchunks(path):
+    chunks = {}
+    with open(path, "rb") as file:
+        riff, size, kind = struct.unpack("<4sI4s", file.read(12))
+        assert riff == b"RIFF" and kind == b"WAVE"
+        assert size == os.path.getsize(path) - 8
+        while True:
+            header = file.read(8)
+            if len(header) < 8:
+                return chunks
+            name, length = struct.unpack("<4sI", header)
+            chunks[name] = file.read(length)
+            file.read(length % 2)
+
+
+def id3frames(tag):
+    assert tag[:5] == b"ID3\x03\x00"
+    size = 0
+    for byte in tag[6:10]:
+        size = size << 7 | byte
+    assert size == len(tag) - 10
+    frames = {}
+    position = 10
+    while position < len(tag):
+        name, length = struct.unpack(">4sI", tag[position:position + 8])
+        frames[name] = tag[position + 10:position + 10 + length]
+        position += 10 + length
+    return frames
+
+
+def test_recorder_writes_id3_chunk(tmp_path):
+    art = nrsc5fake.png(8, 8, (1, 2, 3))
+    sink = nrsc5sink.RecorderSink(str(tmp_path))
+    sink.start()
+    sink.tag(0, {"title": "Title", "artist": "Artist", "art": art})
+    sink.put((0, nrsc5fake.tone(0), None))
+    sink.tag(0, {"title": "Next", "artist": "Artist"})
+    sink.put((0, nrsc5fake.tone(0), None))
+    sink.close()
+
+    assert len(sink.paths) == 2
+    chunks = riffchunks(sink.paths[0])
+    with wave.open(sink.paths[0]) as file:
+        assert file.getnframes() == nrsc5audio.BLOCK_FRAMES
+    frames = id3frames(chunks[b"id3 "])
+    assert frames[b"TIT2"] == b"\x01" + "Title".encode("utf-16")
+    assert frames[b"TPE1"] == b"\x01" + "Artist".encode("utf-16")
+    assert frames[b"APIC"] == b"\x00image/png\x00\x03\x00" + art
+    assert b"APIC" not in id3frames(riffchunks(sink.paths[1])[b"id3 "])
+
+
+def test_flac_recorder_needs_soundfile(tmp_path, monkeypatch):
+    monkeypatch.setitem(sys.modules, "soundfile", None)
+    with pytest.raises(ImportError):
+        nrsc5sink.RecorderSink(str(tmp_path), "flac")
+
+
+def test_decodeid3():
+    # UTF-8 that libnrsc5 handed over as latin-1, then text that really is latin-1, or not latin-1 at all
+    assert nrsc5service.decodeid3("Beyonc\xc3\xa9") == "Beyonc\xe9"
+    assert nrsc5service.decodeid3("Beyonc\xe9") == "Beyonc\xe9"
+    assert nrsc5service.decodeid3("\u4e2d") == "\u4e2d"
+
+
+def test_headless_service(fake):
+    service = nrsc5service.NRSC5service()
+    service.playback = False
+    service.cachelogos = False
+    service.frequency = 90.1
+    sink = service.addsink(1, nrsc5sink.NullSink())
+    service.run()
+    try:
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline and not (sink.blocks and service.station and 1 in service.id3):
+            time.sleep(0.05)
+    finally:
+        service.stop()
+    assert service.station == "FAKE"
+    assert sorted(service.programs) == [0, 1, 2, 3]
+    assert service.id3[1].artist == "Artist 1"
+    assert sink.blocks > 0 and sink.dropped == 0
+    assert service.stats["callbacks"] > 0
+    # inactive programs are let go of by design, which isn't a loss
+    assert service.stats["dropped"] == 0
+    assert service.radio is not None
+
+
+def test_refused_recorder_leaves_radio_closed(tmp_path, fake, monkeypatch):
+    opened = []
+    monkeypatch.setattr(fake, "nrsc5_open", lambda radio, device_index: opened.append(device_index) or 0)
+    monkeypatch.setattr(fake, "nrsc5_close", lambda radio: opened.pop())
+    path = tmp_path / "ring.iq"
+    path.write_bytes(b"capture")
+    service = nrsc5service.NRSC5service()
+    service.playback = False
+    service.cachelogos = False
+    service.frequency = 90.1
+    service.iqrecordfile = str(path)
+    service.tracefile = str(tmp_path / "events.trace")
+    service.run()
+    assert not service.playing
+    assert opened == []
+    assert service.iqrecorder is None and service.tracerecorder is None
+    assert path.read_bytes() == b"capture"
+
+    # a failure after the radio is open closes it again
+    monkeypatch.setattr(fake, "nrsc5_set_frequency", lambda radio, frequency: 1)
+    service.iqrecordfile = None
+    service.tracefile = None
+    service.run()
+    assert not service.playing
+    assert opened == []